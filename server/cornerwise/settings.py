@@ -245,6 +245,21 @@ CELERYBEAT_SCHEDULE = {
 
 CELERYD_TASK_SOFT_TIME_LIMIT = 60
 
+# Document processing stages are routed to queues by the kind of work they do,
+# so that slow downloads or API calls do not starve CPU-bound work. Workers
+# must consume these queues in addition to the default queue.
+CELERY_ROUTES = {
+    "proposal.tasks.fetch_document_stage": {"queue": "network"},
+    "proposal.tasks.extract_text_stage": {"queue": "cpu"},
+    "proposal.tasks.add_doc_attributes_stage": {"queue": "cpu"},
+    "proposal.tasks.extract_images_stage": {"queue": "cpu"},
+    "proposal.tasks.finish_images_stage": {"queue": "cpu"},
+    "proposal.tasks.generate_doc_thumbnail_stage": {"queue": "cpu"},
+    "proposal.tasks.generate_thumbnail": {"queue": "cpu"},
+    "proposal.tasks.generate_thumbnails": {"queue": "cpu"},
+    "proposal.tasks.process_pending_images": {"queue": "api"},
+}
+
 ###########
 # Messages
 from django.contrib.messages import constants as messages
@@ -262,10 +277,61 @@ GEO_BOUNDS = [
 
 # The 'fit-width' of image thumbnails:
 THUMBNAIL_DIM = (300, 300)
+# Thumbnails are generated at each of these sizes from one decode of an image.
+# The default size is saved as the Image's thumbnail.
+THUMBNAIL_SIZES = {"list": THUMBNAIL_DIM,
+                   "detail": (800, 800),
+                   "email": (150, 150)}
+THUMBNAIL_DEFAULT = "list"
+# Number of processes used to generate thumbnails in bulk:
+THUMBNAIL_PROCESSES = 4
 # Set to a color name to pad thumbnails to the desired dimensions
 THUMBNAIL_PAD = None
 
+# One of "google", "arcgis", or "parcel". The parcel geocoder resolves
+# addresses to parcel centroids locally and uses GEOCODER_FALLBACK for misses.
 GEOCODER = "arcgis"
+GEOCODER_FALLBACK = "arcgis"
+# Concurrent geocoder requests, and the provider's queries per second quota:
+GEOCODER_PARALLELISM = 5
+GEOCODER_QPS = 50
+# Cache geocoder results, keyed by normalized address and region:
+GEOCODE_CACHE = True
+# Seconds to keep successful lookups (None: never expire)
+GEOCODE_CACHE_TTL = 60*60*24*90
+# Seconds to keep failed lookups
+GEOCODE_NEGATIVE_TTL = 60*60*24*3
+
+# Images whose perceptual hashes differ in at most this many bits are treated
+# as duplicates, both within a proposal and when reusing the classification of
+# an earlier image (no more than 7):
+IMAGE_HASH_DISTANCE = 6
+
+# Responses to proposal queries are cached for this many seconds, or until a
+# Proposal, Document, or Image changes:
+QUERY_CACHE_TIMEOUT = 60*10
+# Query boxes are expanded to a grid with this spacing (in degrees), so that
+# similar map views share cached responses:
+QUERY_BOX_GRID = 0.005
+
+# Map tiles are versioned individually up to this zoom level; deeper tiles
+# share the version of their ancestor at this level:
+TILE_MAX_ZOOM = 18
+# Proposals in each tile are clustered on a grid with this many cells per side:
+TILE_CLUSTER_CELLS = 16
+# Beyond this zoom level, tiles include every proposal without clustering:
+TILE_CLUSTER_MAX_ZOOM = 17
+
+# Images sent to Cloud Vision in each request (at most 16):
+VISION_BATCH_SIZE = 16
+# Maximum number of concurrent Cloud Vision requests per worker:
+VISION_CONCURRENCY = 4
+# Seconds to wait for more images to be queued before sending a batch:
+VISION_BATCH_DELAY = 10
+# Times to try classifying a queued image before giving up on it:
+VISION_MAX_ATTEMPTS = 3
+# Seconds to keep Cloud Vision results and the text found in images:
+VISION_RESULT_TTL = 60*60*24*30
 
 # Email address and name for emails:
 EMAIL_ADDRESS = "cornerwise@cornerwise.org"
@@ -304,7 +370,15 @@ GEO_REGION = "Somerville, MA"
 AUTHENTICATION_BACKENDS = ["user.auth.TokenBackend",
                            "django.contrib.auth.backends.ModelBackend"]
 
+# Maximum number of importers to fetch at once:
+IMPORTER_CONCURRENCY = 4
+# Seconds to wait on an importer's response before giving up:
+IMPORTER_TIMEOUT = 300
+
 IMPORTER_SCHEMA = "https://raw.githubusercontent.com/codeforboston/cornerwise/master/docs/scraper-schema.json"
+# If it exists, the local copy of the schema is used instead:
+IMPORTER_SCHEMA_PATH = os.path.join(os.path.dirname(BASE_DIR), "docs",
+                                    "scraper-schema.json")
 
 # Site config
 SITE_CONFIG = {
@@ -323,8 +397,8 @@ USE_SITE_HOSTNAMES = True
 # Load select environment variables into settings:
 for envvar in [
         "GOOGLE_API_KEY", "GOOGLE_BROWSER_API_KEY",
-        "GOOGLE_STREET_VIEW_SECRET", "GEOCODER", "ARCGIS_CLIENT_ID",
-        "ARCGIS_CLIENT_SECRET", "SOCRATA_APP_TOKEN", "SOCRATA_APP_SECRET",
+        "GOOGLE_STREET_VIEW_SECRET", "GEOCODER", "GEOCODER_FALLBACK",
+        "ARCGIS_CLIENT_ID", "ARCGIS_CLIENT_SECRET", "SOCRATA_APP_TOKEN", "SOCRATA_APP_SECRET",
         "SENDGRID_API_KEY", "FOURSQUARE_CLIENT", "FOURSQUARE_SECRET",
         "SENDGRID_PARSE_KEY", "SERVER_DOMAIN", "BASE_URL", "SITE_REDIRECT"
 ]:
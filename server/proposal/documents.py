@@ -2,26 +2,110 @@
 Helper functions for working with Documents.
 """
 
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.cache import cache
 from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db.models import F, Subquery, Value
+from django.db.models.expressions import CombinedExpression
+from django.db.models.functions import Coalesce
 
 from dateutil.parser import parse as dt_parse
+import hashlib
+import os
 from os import path
-import subprocess
+import shutil
+import tempfile
 from urllib import parse
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from scripts import pdf
 from shared import files
 from utils import extension
 
-from .models import Image
+from .models import (Document, Image, MAX_INDEXED_CHARS, TEXT_SEARCH_CONFIG,
+                     blob_path, bump_proposal_tiles, bump_query_generation,
+                     delete_unreferenced, send_created_signals,
+                     upload_document_to)
+
+
+# Shared, pooled session for document downloads:
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = (10, 60)
+
+
+def hash_file(file_path, hasher):
+    with open(file_path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def download(url, file_path, headers, resume_key, max_attempts=3):
+    """Streams the resource at `url` to `file_path`, hashing it as it arrives. If
+    the connection is interrupted, resumes from where it left off using a
+    Range request. The ETag or Last-Modified header of the response is stored
+    under `resume_key` in the cache, so that a later call can resume a partial
+    download as long as the resource has not changed.
+
+    :returns: a tuple (response, hasher). The response body has already been
+    consumed. If the response was unsuccessful or 304, nothing is written.
+    """
+    resume_from = cache.get(resume_key)
+    if not resume_from and path.exists(file_path):
+        os.remove(file_path)
+    os.makedirs(path.dirname(file_path), exist_ok=True)
+
+    for attempt in range(max_attempts):
+        offset = path.getsize(file_path) if path.exists(file_path) else 0
+        req_headers = dict(headers)
+        if offset:
+            req_headers["Range"] = f"bytes={offset}-"
+            req_headers["If-Range"] = resume_from
+
+        try:
+            with SESSION.get(url, headers=req_headers, stream=True,
+                             timeout=TIMEOUT) as response:
+                if not response or response.status_code == 304:
+                    return response, None
+
+                if response.status_code == 206:
+                    hasher = hash_file(file_path, hashlib.sha256())
+                    mode = "ab"
+                else:
+                    # The server sent the whole file:
+                    hasher = hashlib.sha256()
+                    mode = "wb"
+                    resume_from = response.headers.get("ETag") or \
+                        response.headers.get("Last-Modified")
+                    cache.set(resume_key, resume_from, 60*60*24)
+
+                with open(file_path, mode) as outfile:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        outfile.write(chunk)
+                        hasher.update(chunk)
+
+            cache.delete(resume_key)
+            return response, hasher
+        except (requests.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.Timeout):
+            if attempt == max_attempts - 1 or not resume_from:
+                raise
 
 
 def save_from_url(doc, url, filename_base=None):
     """
     Downloads the document at `url` and saves it locally, storing the path in
-    the given Document.
+    the given Document. If the document was downloaded before, the request is
+    made conditional on the stored ETag and Last-Modified values. A download
+    whose contents are identical to the existing file is treated as unchanged.
 
     :param doc: a Document model
     :param url: URL string
@@ -36,30 +120,103 @@ def save_from_url(doc, url, filename_base=None):
         filename = "{}.{}".format(filename_base, extension(filename))
 
     exists = doc.document and path.exists(doc.document.path)
+    headers = {}
     if exists:
-        published = doc.published
-        headers = {"If-Modified-Since": published.strftime("%a, %d %b %Y %H:%M:%S GMT")}
+        if doc.etag:
+            headers["If-None-Match"] = doc.etag
+        if doc.last_modified:
+            headers["If-Modified-Since"] = doc.last_modified
+
+    name = upload_document_to(doc, filename)
+    partial_path = default_storage.path(name) + ".part"
+    response, hasher = download(url, partial_path, headers,
+                                f"doc:{doc.pk}:partial")
+
+    if not response:
+        return (False, response.status_code, response.reason)
+
+    doc.etag = response.headers.get("ETag", doc.etag)
+    doc.last_modified = response.headers.get("Last-Modified", doc.last_modified)
+
+    if response.status_code == 304 or \
+       (exists and hasher.hexdigest() == doc.content_hash):
+        if path.exists(partial_path):
+            os.remove(partial_path)
+        doc.save()
+        return (True, 304, False)
+
+    doc.content_hash = hasher.hexdigest()
+    name = blob_path(doc.content_hash, filename)
+    if default_storage.exists(name):
+        # Another document already has the same contents:
+        os.remove(partial_path)
     else:
-        headers = {}
+        os.makedirs(path.dirname(default_storage.path(name)), exist_ok=True)
+        os.replace(partial_path, default_storage.path(name))
 
-    with requests.get(url, headers=headers, stream=True) as response:
-        if response:
-            if response.status_code == 304:
-                return (True, response.status_code, False)
+    if exists and doc.document.name != name:
+        delete_unreferenced(doc.document, Document, "document", doc.pk)
+    doc.document.name = name
 
-            doc.document.save(filename, File(response.raw), save=False)
+    # The publication date in the file's metadata, if any, is read when its
+    # text is extracted.
+    if doc.last_modified:
+        doc.published = dt_parse(doc.last_modified)
 
-            file_published = files.published_date(doc.document.path)
+    doc.save()
+    return (True, response.status_code, exists)
 
-            if file_published:
-                doc.published = file_published
-            elif "Last-Modified" in response.headers:
-                doc.published = dt_parse(response.headers["Last-Modified"])
 
-            doc.save()
-            return (True, response.status_code, exists)
-        else:
-            return (False, response.status_code, response.reason)
+def find_processed_copy(doc, stages):
+    """Find another Document with the same contents as `doc` that has completed
+    all of the given processing stages.
+    """
+    if not doc.content_hash:
+        return None
+
+    return Document.objects.filter(content_hash=doc.content_hash,
+                                   completed_stages__contains=list(stages))\
+                           .exclude(pk=doc.pk)\
+                           .exclude(fulltext="")\
+                           .exclude(fulltext__isnull=True)\
+                           .first()
+
+
+def copy_processed(doc, source):
+    """Share the extracted text, thumbnail, and images of `source`, a Document
+    with the same contents, rather than processing `doc` again.
+
+    :returns: the new Images
+    """
+    doc.fulltext = source.fulltext.name
+    doc.encoding = source.encoding
+    doc.page_offsets = source.page_offsets
+    if source.thumbnail:
+        doc.thumbnail = source.thumbnail.name
+    doc.save()
+    Document.objects.filter(pk=doc.pk).update(
+        search_vector=Subquery(Document.objects.filter(pk=source.pk)
+                               .values("search_vector")[:1]))
+    doc.refresh_from_db(fields=["search_vector"])
+
+    existing = set(doc.proposal.images.values_list("image", flat=True))
+    images = [Image(proposal_id=doc.proposal_id,
+                    document=doc,
+                    image=image.image.name,
+                    thumbnail=image.thumbnail.name or None,
+                    width=image.width,
+                    height=image.height,
+                    priority=image.priority,
+                    source=image.source)
+              for image in source.images.exclude(image__in=existing)]
+    images = Image.objects.bulk_create(images)
+
+    # Neither bulk_create() nor update() sends signals, so invalidate the
+    # cached responses that would have been invalidated by save():
+    send_created_signals(images)
+    bump_query_generation()
+    bump_proposal_tiles([doc.proposal])
+    return images
 
 
 def save_images(doc):
@@ -89,41 +246,90 @@ def generate_thumbnail(doc):
         raise FileNotFoundError(
             "Document has not been copied to the local filesystem")
 
-    doc_path = doc.document.path
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        thumb_path = files.render_thumbnail(
+            doc.document.path, path.join(tmp_dir, "thumbnail.jpg"))
 
-    # TODO: Dispatch on extension. Handle other common file types
-    if extension(doc_path) != "pdf":
-        return
+        if thumb_path:
+            with open(thumb_path, "rb") as thumb_file:
+                doc.thumbnail.save("thumbnail.jpg", File(thumb_file))
 
-    out_prefix = path.join(path.dirname(doc_path), "thumbnail")
+    return thumb_path
 
-    proc = subprocess.Popen(
-        [
-            "pdftoppm", "-jpeg", "-singlefile", "-scale-to", "200", doc_path,
-            out_prefix
-        ],
-        stderr=subprocess.PIPE)
-    _, err = proc.communicate()
 
-    if proc.returncode:
-        raise Exception("Failed for document %s" % doc.pk, err)
+def extract_text(doc):
+    """Extract the document's text to a file. Where the file type allows, the
+    thumbnail and publication date are read at the same time, so the document
+    is only opened once.
 
-    thumb_path = out_prefix + path.extsep + "jpg"
-    with open(thumb_path, "rb") as thumb_file:
-        doc.thumbnail.save("thumbnail.jpg", File(thumb_file))
+    Derived files are written under the document's own directory, not next to
+    the shared download, so documents with the same contents can be
+    processed at the same time.
 
-    return thumb_path
+    :returns: a dict with the keys 'published' and 'thumbnail' if successful
+    """
+    text_name = text_file_name(doc)
+    text_path = default_storage.path(text_name)
+    os.makedirs(path.dirname(text_path), exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result = files.extract(doc.local_path, text_path,
+                               path.join(tmp_dir, "thumbnail.jpg"))
+
+        if not result:
+            return None
+
+        doc.fulltext = text_name
+        doc.encoding = "utf-8"
+        doc.page_offsets = result["pages"]
+        if result.get("published"):
+            doc.published = result["published"]
+        if result.get("thumbnail"):
+            with open(result["thumbnail"], "rb") as thumb_file:
+                doc.thumbnail.save("thumbnail.jpg", File(thumb_file),
+                                   save=False)
+    doc.save()
+    index_text(doc)
+
+    return result
+
+
+def text_file_name(doc):
+    return upload_document_to(doc, "text.txt")
+
+
+def own_text_file(doc):
+    """:returns: the path of the document's extracted text, first copying the
+    file if it is shared with another document
+    """
+    text_name = text_file_name(doc)
+    text_path = default_storage.path(text_name)
+    os.makedirs(path.dirname(text_path), exist_ok=True)
+    if doc.fulltext and doc.fulltext.name != text_name:
+        shutil.copyfile(doc.fulltext.path, text_path)
+    doc.fulltext = text_name
+    return text_path
 
 
-def extract_text(doc):
-    # Could consider storing the full extracted text of the document in
-    # the database and indexing it, rather than extracting it to a file.
-    text_path = path.join(path.dirname(doc.local_path), "text.txt")
+def text_vector(text):
+    return SearchVector(Value(text[:MAX_INDEXED_CHARS]),
+                        config=TEXT_SEARCH_CONFIG)
 
-    if files.extract_text(doc.local_path, text_path):
-        doc.fulltext = text_path
-        doc.encoding = files.encoding(doc.local_path)
-        doc.save()
-        return True
 
-    return False
+def index_text(doc):
+    """Replace the document's full text search index with the contents of its
+    extracted text.
+    """
+    Document.objects.filter(pk=doc.pk)\
+                    .update(search_vector=text_vector(doc.get_text()))
+    doc.refresh_from_db(fields=["search_vector"])
+
+
+def append_index_text(doc, text):
+    """Add `text` to the document's full text search index without indexing the
+    rest of the document again.
+    """
+    Document.objects.filter(pk=doc.pk).update(
+        search_vector=CombinedExpression(
+            Coalesce(F("search_vector"), text_vector("")), "||",
+            text_vector(text), output_field=SearchVectorField()))
+    doc.refresh_from_db(fields=["search_vector"])
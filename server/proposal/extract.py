@@ -274,13 +274,19 @@ def somerville_properties(lines):
     return props
 
 
+# The properties and project description of a staff report are found in its
+# first few pages, so the remainder of the text need not be read.
+STAFF_REPORT_PAGES = 8
+
+
 @extractor(SomervilleMA, field_matches(r"^reports$"),
            title_matches(r"(?i)staff report"))
 def staff_report_properties(doc):
     """Extract a dictionary of properties from the plaintext contents of a
     Planning Staff Report.
     """
-    sections = staff_report_sections(filter_lines(doc.line_iterator, STRIP_LINES))
+    sections = staff_report_sections(
+        filter_lines(doc.lines(0, STAFF_REPORT_PAGES), STRIP_LINES))
     props = {}
 
     props.update(somerville_properties(sections["header"]))
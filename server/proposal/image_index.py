@@ -0,0 +1,138 @@
+"""
+A perceptual hash index of images that have already been classified, so that
+logos and other images that appear again and again need not be sent to the
+Cloud Vision API.
+
+Hashes are 64 bits, split into 8 bands of 8 bits. Two hashes that differ in
+fewer than 8 bits must share at least one band, so only the hashes that share
+a band with the query need to be compared.
+"""
+import pickle
+
+from django.conf import settings
+
+from redis_utils import Redis
+from scripts import vision
+
+BANDS = 8
+BAND_BITS = 64 // BANDS
+
+
+def bands(phash):
+    mask = (1 << BAND_BITS) - 1
+    return [(phash >> (i * BAND_BITS)) & mask for i in range(BANDS)]
+
+
+def band_key(i, value):
+    return f"phash:band:{i}:{value}"
+
+
+def entry_key(phash):
+    return f"phash:{phash:016x}"
+
+
+def to_signed(phash):
+    "Convert a hash to a value that fits in a signed 64-bit database column."
+    return phash - (1 << 64) if phash >= (1 << 63) else phash
+
+
+def from_signed(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+# Parts of a classification that are shared with similar images. Text is
+# excluded: pages of text often have nearly identical hashes, and one
+# document's text must not be added to another's.
+SHARED_FIELDS = ("logo", "textual", "empty_streetview")
+
+
+def add(phash, classification):
+    """Record the classification of an image with the given hash. Only the
+    SHARED_FIELDS are stored. Textual images are not recorded, so that every
+    page of text is sent for text detection.
+
+    :param classification: a dict, as returned by vision.process_image
+    """
+    if classification.get("textual"):
+        return
+
+    classification = {k: classification.get(k) for k in SHARED_FIELDS}
+    with Redis.pipeline() as p:
+        p.set(entry_key(phash), pickle.dumps(classification))
+        for i, value in enumerate(bands(phash)):
+            p.sadd(band_key(i, value), phash)
+        p.execute()
+
+
+def lookup(phash, max_distance=None):
+    """Find the classification of the closest previously classified image.
+
+    :returns: the classification, or None if there is no image within
+    `max_distance` bits
+    """
+    if max_distance is None:
+        max_distance = settings.IMAGE_HASH_DISTANCE
+
+    candidates = Redis.sunion(
+        [band_key(i, value) for i, value in enumerate(bands(phash))])
+    best = None
+    for candidate in map(int, candidates):
+        distance = vision.hash_distance(phash, candidate)
+        if distance <= max_distance and \
+           (best is None or distance < best[0]):
+            best = (distance, candidate)
+
+    if best:
+        entry = Redis.get(entry_key(best[1]))
+        return entry and pickle.loads(entry)
+
+
+def image_hash(image):
+    """Calculate (and store) the perceptual hash of a proposal.models.Image.
+
+    :returns: the hash, or None if the image is not stored locally
+    """
+    if image.phash is not None:
+        return from_signed(image.phash)
+
+    if not image.image:
+        return None
+
+    try:
+        phash = vision.dhash(image.image.path)
+    except OSError:
+        return None
+    image.phash = to_signed(phash)
+    image.save(update_fields=["phash"])
+    return phash
+
+
+def collapse_duplicates(images, others=(), max_distance=None):
+    """Delete images that are near duplicates of other images of the same
+    proposal. Where the new images duplicate each other, the largest is kept.
+
+    :param images: new Images
+    :param others: Images that were already processed
+
+    :returns: the images that were kept
+    """
+    if max_distance is None:
+        max_distance = settings.IMAGE_HASH_DISTANCE
+
+    kept_hashes = [from_signed(other.phash) for other in others
+                   if other.phash is not None]
+    kept = []
+    for image in sorted(images, key=lambda i: i.width * i.height,
+                        reverse=True):
+        phash = image_hash(image)
+        if phash is not None and \
+           any(vision.hash_distance(phash, h) <= max_distance
+               for h in kept_hashes):
+            image.delete()
+            continue
+
+        if phash is not None:
+            kept_hashes.append(phash)
+        kept.append(image)
+
+    return kept
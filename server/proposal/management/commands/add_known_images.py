@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from proposal import image_index
+from scripts import vision
+
+
+class Command(BaseCommand):
+    help = ("Add images, such as city seals, to the index of classified "
+            "images so that matching images are handled without calling the "
+            "Cloud Vision API")
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", metavar="path")
+        parser.add_argument("--logo", metavar="DESCRIPTION",
+                            help=("Classify the images as logos. Logos whose "
+                                  "description contains the city name are "
+                                  "deleted."))
+        parser.add_argument("--textual", action="store_true",
+                            help="Classify the images as text")
+
+    def handle(self, *args, **options):
+        if not (options["logo"] or options["textual"]):
+            raise CommandError("Specify --logo or --textual")
+
+        classification = {
+            "logo": options["logo"] and {"description": options["logo"],
+                                         "score": 1.0},
+            "textual": options["textual"],
+            "empty_streetview": False
+        }
+
+        for path in options["paths"]:
+            image_index.add(vision.dhash(path), classification)
+            self.stdout.write(self.style.SUCCESS(f"Added {path}\n"))
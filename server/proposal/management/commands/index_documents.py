@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from proposal.models import Document
+from proposal.documents import index_text
+
+
+class Command(BaseCommand):
+    help = "Add the text of documents extracted before text search to the index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true",
+                            help="Index all documents with extracted text")
+
+    def handle(self, *args, **options):
+        docs = Document.objects.exclude(fulltext="")\
+                               .exclude(fulltext__isnull=True)
+        if not options["all"]:
+            docs = docs.filter(search_vector__isnull=True)
+
+        count = 0
+        for doc in docs.iterator():
+            try:
+                index_text(doc)
+                count += 1
+            except OSError as err:
+                self.stderr.write(f"Document #{doc.pk}: {err}\n")
+
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} document(s)\n"))
@@ -6,9 +6,7 @@ from datetime import datetime, timedelta
 import json
 from urllib.request import urlopen
 
-from proposal.models import Importer, get_importer_schema
-
-from jsonschema import Draft4Validator
+from proposal.models import Importer, get_importer_validators
 
 
 def schema_path_str(path):
@@ -22,7 +20,7 @@ class Command(BaseCommand):
         err = lambda m: self.stderr.write(self.style.ERROR(m) + "\n")
         succ = lambda m: self.stdout.write(self.style.SUCCESS(m) + "\n")
         when = datetime.now() - timedelta(days=30)
-        validator = Draft4Validator(get_importer_schema())
+        validator, _ = get_importer_validators()
 
         for importer in Importer.objects.all():
             errors = defaultdict(list)
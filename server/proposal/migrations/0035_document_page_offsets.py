@@ -0,0 +1,17 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0034_document_download_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='page_offsets',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, null=True, size=None),
+        ),
+    ]
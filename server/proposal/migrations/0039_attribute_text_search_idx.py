@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0038_proposal_cursor_indexes'),
+    ]
+
+    # The expression must match the one generated by run_attributes_query.
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX attribute_text_search_idx ON proposal_attribute "
+            "USING gin (to_tsvector('english'::regconfig, "
+            "COALESCE(text_value, '')))",
+            "DROP INDEX attribute_text_search_idx",
+        ),
+    ]
@@ -0,0 +1,17 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0039_attribute_text_search_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='completed_stages',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=16), blank=True, default=list, editable=False, size=None),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Documents processed before stages were recorded have finished every
+    stage that left a result behind.
+    """
+
+    dependencies = [
+        ('proposal', '0040_document_completed_stages'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "UPDATE proposal_document "
+            "SET completed_stages = "
+            "ARRAY['fetch', 'text', 'attributes', 'images']::varchar[] || "
+            "CASE WHEN thumbnail <> '' THEN ARRAY['thumbnail']::varchar[] "
+            "ELSE ARRAY[]::varchar[] END "
+            "WHERE fulltext <> '' AND completed_stages = '{}'",
+            migrations.RunSQL.noop,
+        ),
+    ]
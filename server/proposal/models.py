@@ -1,17 +1,25 @@
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timedelta, tzinfo
 
 from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
 from django.contrib.postgres import fields, indexes
+from django.contrib.postgres.search import SearchVectorField
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.core.validators import MinValueValidator
 from django.dispatch import receiver
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Case, Q, Value, When
+from django.db.models.functions import Cast
 from django.forms.models import model_to_dict
 from django.urls import reverse
 from django.utils import dateparse, timezone
 
+import io
 import json
+import os
 import pickle
 import pytz
 import re
@@ -22,6 +30,8 @@ from dateutil.parser import parse as date_parse
 import jsonschema
 import pytz
 
+from . import tiles
+
 
 RegionTimeZones = {
     "somerville, ma": "US/Eastern",
@@ -105,6 +115,46 @@ def forgiving_dateparse(dt):
     return None
 
 
+def bulk_update(objs, fields, batch_size=500):
+    """Saves the named fields of model instances `objs`, which must all be of the
+    same type, using a single UPDATE query per batch. Stands in for
+    QuerySet.bulk_update(), which is not available until Django 2.2.
+
+    """
+    objs = list(objs)
+    if not objs:
+        return
+
+    model = type(objs[0])
+    fields = [model._meta.get_field(name) for name in fields]
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i+batch_size]
+        # Without the Cast, Postgres infers text for a batch of NULLs
+        updates = {
+            field.attname: Cast(
+                Case(*[When(pk=obj.pk,
+                            then=Value(getattr(obj, field.attname),
+                                       output_field=field))
+                       for obj in batch],
+                     output_field=field),
+                output_field=field)
+            for field in fields
+        }
+        model.objects.filter(pk__in=[obj.pk for obj in batch])\
+                     .update(**updates)
+
+
+def send_created_signals(objs):
+    """Sends post_save for instances that were saved with bulk_create(), so that
+    receivers listening for new objects are still notified.
+
+    """
+    for obj in objs:
+        models.signals.post_save.send(sender=type(obj), instance=obj,
+                                      created=True, update_fields=None,
+                                      raw=False, using=obj._state.db)
+
+
 class Proposal(models.Model):
     case_number = models.CharField(
         max_length=64,
@@ -153,7 +203,12 @@ class Proposal(models.Model):
 
     class Meta:
         indexes = [
-            indexes.GinIndex(fields=["case_numbers"], name="case_numbers_idx")
+            indexes.GinIndex(fields=["case_numbers"], name="case_numbers_idx"),
+            # For paging with a cursor:
+            models.Index(fields=["updated", "id"],
+                         name="proposal_updated_id_idx"),
+            models.Index(fields=["started", "id"],
+                         name="proposal_started_id_idx"),
         ]
 
     def __str__(self):
@@ -180,6 +235,181 @@ class Proposal(models.Model):
 
         return (created, proposal)
 
+    @classmethod
+    def create_or_update_from_dicts(cls, p_dicts, tz: tzinfo=pytz.utc,
+                                    on_error=None):
+        """Batch version of create_or_update_from_dict, for use with the full list
+        of cases returned by the importers. Existing proposals, attributes and
+        documents are loaded up front with a handful of queries, and the
+        results are written back using bulk inserts and updates. Changesets
+        are generated exactly as they would be by update_from_dict.
+
+        :param p_dicts: iterable of dictionaries describing proposals
+        :param on_error: optional function called with (p_dict, exception)
+        when a dictionary cannot be applied. If omitted, the exception is
+        raised.
+
+        :returns: a list of (created, proposal) pairs, in input order
+        """
+        p_dicts = list(p_dicts)
+        existing = cls.objects.in_bulk([d["case_number"] for d in p_dicts
+                                        if "case_number" in d],
+                                       field_name="case_number")
+
+        # Maps case numbers to (proposal, created, updates), where updates is
+        # a list of (p_dict, changed, prop_changes, updated) tuples:
+        pending = OrderedDict()
+        results = []
+        for p_dict in p_dicts:
+            try:
+                case_number = p_dict["case_number"]
+                if case_number in pending:
+                    proposal, created, _ = pending[case_number]
+                else:
+                    proposal = existing.get(case_number)
+                    created = proposal is None
+                    if created:
+                        proposal = cls(case_number=case_number)
+                changed = case_number in pending or not created
+
+                proposal.case_numbers = p_dict.get("case_numbers", [])
+                prop_changes, updated = proposal._update_properties(
+                    p_dict, changed, tz)
+                if "importer" in p_dict:
+                    proposal.importer = p_dict["importer"]
+            except Exception as exc:
+                if not on_error:
+                    raise
+                on_error(p_dict, exc)
+                continue
+
+            pending.setdefault(case_number, (proposal, created, []))[2]\
+                   .append((p_dict, changed, prop_changes, updated))
+            results.append((created, proposal))
+
+        if not pending:
+            return results
+
+        try:
+            cls._save_pending(pending, on_error)
+        except Exception:
+            if not on_error:
+                raise
+            # Fall back to saving the cases one at a time, so that one bad
+            # case does not prevent the rest from being imported:
+            return cls._create_or_update_each(
+                [p_dict for _, _, updates in pending.values()
+                 for p_dict, *_ in updates], tz, on_error)
+
+        return results
+
+    @classmethod
+    def _create_or_update_each(cls, p_dicts, tz, on_error):
+        results = []
+        for p_dict in p_dicts:
+            try:
+                with transaction.atomic():
+                    results.append(cls.create_or_update_from_dict(p_dict, tz))
+            except Exception as exc:
+                on_error(p_dict, exc)
+        return results
+
+    @classmethod
+    def _save_pending(cls, pending, on_error):
+        with transaction.atomic():
+            new_proposals = [p for p, created, _ in pending.values() if created]
+            old_proposals = [p for p, created, _ in pending.values()
+                             if not created]
+            cls.objects.bulk_create(new_proposals)
+            now = timezone.now()
+            for proposal in old_proposals:
+                proposal.modified = now
+            bulk_update(old_proposals,
+                        [f.name for f in cls._meta.concrete_fields
+                         if not f.primary_key])
+
+            old_ids = [p.pk for p in old_proposals]
+            attributes = defaultdict(dict)
+            for attr in Attribute.objects.filter(proposal_id__in=old_ids)\
+                                         .order_by("pk"):
+                attributes[attr.proposal_id][attr.handle] = attr
+            documents = defaultdict(dict)
+            for doc in Document.objects.filter(proposal_id__in=old_ids):
+                documents[doc.proposal_id][doc.url] = doc
+
+            new_attrs, updated_attrs = [], {}
+            new_docs, updated_docs = [], {}
+            changesets = []
+            for proposal, _, updates in pending.values():
+                for p_dict, changed, prop_changes, updated in updates:
+                    try:
+                        # Each case gets a savepoint, so that a bad event,
+                        # document or attribute only affects its own case:
+                        with transaction.atomic():
+                            case_docs, case_attrs, case_changeset = \
+                                proposal._apply_related(
+                                    p_dict, changed, prop_changes, updated,
+                                    documents[proposal.pk],
+                                    attributes[proposal.pk])
+                    except Exception as exc:
+                        if not on_error:
+                            raise
+                        on_error(p_dict, exc)
+                        continue
+
+                    for is_new, doc in case_docs:
+                        if is_new:
+                            new_docs.append(doc)
+                        elif doc.pk:
+                            updated_docs[doc.pk] = doc
+                    added, changed_attrs = case_attrs
+                    new_attrs.extend(added)
+                    updated_attrs.update((a.pk, a) for a in changed_attrs)
+                    if case_changeset:
+                        changesets.append(case_changeset)
+
+            Document.objects.bulk_create(new_docs)
+            bulk_update(updated_docs.values(), ["tags", "title"])
+            Attribute.objects.bulk_create(new_attrs)
+            bulk_update(updated_attrs.values(),
+                        ["date_value", "text_value", "published"])
+            Changeset.objects.bulk_create(changesets)
+
+        # bulk_create() does not send signals, so notify the receivers that
+        # would otherwise have been triggered by save():
+        send_created_signals(new_proposals)
+        send_created_signals(new_docs)
+        bump_query_generation()
+        bump_proposal_tiles(old_proposals)
+
+    def _apply_related(self, p_dict, changed, prop_changes, updated,
+                       documents, attributes):
+        """Applies the events, documents and attributes of one case to an
+        existing or newly created proposal. Events are saved immediately;
+        documents, attributes and the changeset are returned to be saved in
+        bulk.
+        """
+        importer = p_dict.get("importer")
+        for event in self.create_events(p_dict.get("events", [])):
+            if not event.importer:
+                event.importer = importer
+            event.proposals.add(self)
+
+        docs = list(self._update_documents(p_dict.get("documents", []),
+                                           documents))
+        added, changed_attrs, attr_changes = self._update_attributes(
+            p_dict.get("attributes", []), attributes, updated)
+
+        changeset = None
+        if changed:
+            changeset = Changeset.from_changes(self, {
+                "properties": [ch for ch in prop_changes
+                               if ch["old"] != ch["new"]],
+                "attributes": [ch for ch in attr_changes
+                               if ch["old"] != ch["new"]]
+            })
+        return docs, (added, changed_attrs), changeset
+
     @property
     def attribute_dict(self):
         return dict(self.attributes.values_list("name", "text_value"))
@@ -199,8 +429,43 @@ class Proposal(models.Model):
         is True, the update will generate a new Changeset describing the state
         of the proposal before and after the changes from p_dict were applied.
         """
+        prop_changes, updated = self._update_properties(p_dict, changed, tz)
+
+        self.save()
+
+        importer = p_dict.get("importer")
+        # Add related events:
+        for event in self.create_events(p_dict.get("events", [])):
+            if not event.importer:
+                event.importer = importer
+            event.proposals.add(self)
+
+        # Create associated documents:
+        self.create_documents(p_dict.get("documents", []))
+
+        existing = {attr.handle: attr
+                    for attr in self.attributes.order_by("pk")}
+        new_attrs, changed_attrs, attr_changes = self._update_attributes(
+            p_dict.get("attributes", []), existing, updated)
+        for attr in changed_attrs:
+            attr.save()
+        for attr in new_attrs:
+            attr.save()
+
         if changed:
-            prop_changes = []
+            changeset = Changeset.from_changes(self, {
+                "properties": [ch for ch in prop_changes if ch["old"] != ch["new"]],
+                "attributes": [ch for ch in attr_changes if ch["old"] != ch["new"]]
+            })
+            changeset.save()
+            return changeset
+
+    def _update_properties(self, p_dict, changed, tz):
+        """Sets the properties of the Proposal from p_dict without saving.
+
+        :returns: a tuple of (property changes, updated datetime)
+        """
+        prop_changes = []
 
         first_hearing_date = forgiving_dateparse(p_dict.get("first_hearing_date"))
 
@@ -241,22 +506,21 @@ class Proposal(models.Model):
                 raise Exception("Missing required property: %s\n Reason: %s" %
                                 (prop, exc))
 
-        self.save()
+        return prop_changes, updated
 
-        importer = p_dict.get("importer")
-        # Add related events:
-        for event in self.create_events(p_dict.get("events", [])):
-            if not event.importer:
-                event.importer = importer
-            event.proposals.add(self)
+    def _update_attributes(self, attributes, existing, updated):
+        """Applies the attribute name/value pairs in `attributes` without saving.
 
-        # Create associated documents:
-        self.create_documents(p_dict.get("documents", []))
+        :param existing: a dict mapping handles to this Proposal's saved
+        Attributes. Newly created Attributes are added to it.
+        :param updated: the published date for new or changed values
 
-        if changed:
-            attr_changes = []
+        :returns: a tuple of (new Attributes, changed Attributes, changes)
+        """
+        new_attrs = []
+        changed_attrs = []
+        attr_changes = []
 
-        attributes = p_dict.get("attributes", [])
         if hasattr(attributes, "items"):
             attributes = attributes.items()
         for attr_name, attr_val in attributes:
@@ -264,60 +528,70 @@ class Proposal(models.Model):
                 date_value = date_parse(attr_val)
             except (ValueError, TypeError) as _:
                 date_value = None
-            try:
-                handle = utils.normalize(attr_name)
-                attr = self.attributes.get(handle=handle)
+            handle = utils.normalize(attr_name)
+            attr = existing.get(handle)
+            if attr:
                 if attr.ignore_updates:
                     continue
                 old_val = attr.text_value
                 attr.date_value = date_value
                 attr.text_value = attr_val
                 attr.published = updated
-                attr.save()
-            except Attribute.DoesNotExist:
-                self.attributes.create(
+                if attr.pk and attr not in changed_attrs:
+                    changed_attrs.append(attr)
+            else:
+                attr = Attribute(
+                    proposal=self,
                     name=attr_name,
                     handle=handle,
                     date_value=date_value,
                     text_value=attr_val,
                     published=updated)
+                existing[handle] = attr
+                new_attrs.append(attr)
                 old_val = None
-            if changed:
-                attr_changes.append({
-                    "name": attr_name,
-                    "old": old_val,
-                    "new": attr_val
-                })
-
-        if changed:
-            changeset = Changeset.from_changes(self, {
-                "properties": [ch for ch in prop_changes if ch["old"] != ch["new"]],
-                "attributes": [ch for ch in attr_changes if ch["old"] != ch["new"]]
+            attr_changes.append({
+                "name": attr_name,
+                "old": old_val,
+                "new": attr_val
             })
-            changeset.save()
-            return changeset
+
+        return new_attrs, changed_attrs, attr_changes
 
     def create_documents(self, docs):
         return list(self.do_create_documents(docs))
 
     def do_create_documents(self, docs):
+        existing = {doc.url: doc for doc in
+                    self.documents.filter(url__in=[d["url"] for d in docs])}
+        for created, doc in self._update_documents(docs, existing):
+            doc.save()
+            yield (created, doc)
+
+    def _update_documents(self, docs, existing):
+        """Applies the document links in `docs` without saving.
+
+        :param existing: a dict mapping URLs to this Proposal's saved
+        Documents. Newly created Documents are added to it.
+        """
         for doc_link in docs:
             taglist = ",".join(doc_link.get("tags"))
             field = doc_link.get("tags", [None])[0]
-            try:
-                doc = self.documents.get(url=doc_link["url"])
+            doc = existing.get(doc_link["url"])
+            if doc:
                 if taglist:
                     doc.tags = taglist
                 if doc_link.get("title"):
                     doc.title = doc_link["title"]
-                doc.save()
                 yield (False, doc)
-            except Document.DoesNotExist:
-                doc = self.documents.create(url=doc_link["url"],
-                                            title=doc_link["title"],
-                                            field=field,
-                                            tags=taglist,
-                                            published=self.updated)
+            else:
+                doc = Document(proposal=self,
+                               url=doc_link["url"],
+                               title=doc_link["title"],
+                               field=field,
+                               tags=taglist,
+                               published=self.updated)
+                existing[doc.url] = doc
                 yield (True, doc)
 
     def create_events(self, event_dicts):
@@ -496,10 +770,38 @@ class Event(models.Model):
         return event
 
 
+# Postgres text search configuration used for Document text:
+TEXT_SEARCH_CONFIG = "english"
+# Postgres cannot index arbitrarily long text, so only the beginning of very
+# large documents is searchable:
+MAX_INDEXED_CHARS = 500000
+
+
 def upload_document_to(doc, filename):
     return "doc/%s/%s" % (doc.pk, filename)
 
 
+def blob_path(content_hash, filename):
+    """Content-addressed path for a downloaded document. Documents with identical
+    contents share the file, along with the text extracted alongside it.
+    """
+    return "blob/%s/%s/%s" % (content_hash[0:2], content_hash, filename)
+
+
+def delete_unreferenced(field_file, model, field_name, exclude_pk=None):
+    """Deletes the file unless it is still referenced by another instance of
+    `model`, since files may be shared by instances with the same content.
+    """
+    if not field_file:
+        return
+    others = model.objects.filter(**{field_name: field_file.name})
+    if exclude_pk is not None:
+        others = others.exclude(pk=exclude_pk)
+    if not others.exists():
+        field_file.delete(save=False)
+        return True
+
+
 class DocumentQuerySet(models.QuerySet):
     def with_tag(self, tag):
         return self.filter(tags__iregex=r"(?:,|^)" + tag + r"(?:,$)")
@@ -531,10 +833,27 @@ class Document(models.Model):
 
     # If the document has been copied to the local filesystem:
     document = models.FileField(null=True, upload_to=upload_document_to)
+    # Validators from the response headers of the last download, sent with
+    # the next request to avoid downloading unchanged files:
+    etag = models.CharField(max_length=256, blank=True, default="")
+    last_modified = models.CharField(max_length=64, blank=True, default="")
+    # SHA-256 hex digest of the downloaded file:
+    content_hash = models.CharField(max_length=64, blank=True, default="",
+                                    db_index=True)
 
     # File containing extracted text of the document:
     fulltext = models.FileField(null=True)
     encoding = models.CharField(max_length=20, default="")
+    # Byte offsets of the start of each page in the text file, followed by
+    # its length:
+    page_offsets = fields.ArrayField(models.IntegerField(), null=True,
+                                     blank=True)
+    # Full text search index of the extracted text:
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Processing stages that have finished (see proposal.tasks):
+    completed_stages = fields.ArrayField(models.CharField(max_length=16),
+                                         default=list, blank=True,
+                                         editable=False)
     # File containing a thumbnail of the document:
     thumbnail = models.FileField(null=True, upload_to=upload_document_to)
 
@@ -543,13 +862,30 @@ class Document(models.Model):
     class Meta:
         # Ensure at the DB level that documents are not duplicated:
         unique_together = (("proposal", "url"))
+        indexes = [
+            indexes.GinIndex(fields=["search_vector"],
+                             name="document_search_idx")
+        ]
+
+    def save(self, *args, **kwargs):
+        # completed_stages is only changed by UPDATE queries (see
+        # proposal.tasks.mark_stage_done), so that a task saving its copy of
+        # the document does not discard stages finished by other tasks:
+        if self.pk and not args and not kwargs.get("force_insert") and \
+           kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != "completed_stages"]
+        super().save(*args, **kwargs)
 
     def get_absolute_url(self):
         return reverse("view-document", kwargs={"pk": self.pk})
 
     def to_dict(self):
         d = model_to_dict(
-            self, exclude=["event", "document", "fulltext", "thumbnail"])
+            self, exclude=["event", "document", "fulltext", "thumbnail",
+                           "etag", "last_modified", "content_hash",
+                           "page_offsets"])
         if self.thumbnail:
             d["thumb"] = self.thumbnail.url
 
@@ -559,16 +895,56 @@ class Document(models.Model):
         return d
 
     def get_text(self):
-        with open(self.fulltext.path, "r", encoding=self.encoding) as f:
+        with open(self.fulltext.path, "r", encoding=self.encoding or "utf-8",
+                  errors="replace") as f:
             return f.read()
 
+    @property
+    def page_count(self):
+        return len(self.page_offsets) - 1 if self.page_offsets else None
+
+    def read_pages(self, start=0, end=None):
+        """Read the text of pages `start` up to (but not including) `end`.
+        Negative page numbers count back from the last page.
+        """
+        if not self.page_offsets:
+            # Text extracted before pages were indexed:
+            pages = self.get_text().split("\f")
+            return "\f".join(pages[start:end])
+
+        page_nums = range(self.page_count)[start:end]
+        if not page_nums:
+            return ""
+
+        begin = self.page_offsets[page_nums[0]]
+        with open(self.fulltext.path, "rb") as f:
+            f.seek(begin)
+            data = f.read(self.page_offsets[page_nums[-1] + 1] - begin)
+
+        return data.decode("utf-8", "replace")
+
+    def pages(self):
+        "Generates the text of each page in turn."
+        if not self.page_offsets:
+            yield from self.get_text().split("\f")
+            return
+
+        with open(self.fulltext.path, "rb") as f:
+            for begin, end in zip(self.page_offsets, self.page_offsets[1:]):
+                f.seek(begin)
+                yield f.read(end - begin).decode("utf-8", "replace")
+
+    def lines(self, start=0, end=None):
+        "Returns an iterator over the lines of the given pages."
+        return io.StringIO(self.read_pages(start, end), newline="\n")
+
     @property
     def tag_set(self):
         return set(filter(len, map(str.strip, self.tags.split(","))))
 
     @property
     def line_iterator(self):
-        return (line.decode(self.encoding) for line in self.fulltext)
+        return self.lines()
 
     @property
     def local_path(self):
@@ -582,12 +958,9 @@ def auto_delete_document(**kwargs):
 
     """
     document = kwargs["instance"]
-    if document.document:
-        document.document.delete(save=False)
-    if document.thumbnail:
-        document.thumbnail.delete(save=False)
-    if document.fulltext:
-        document.fulltext.delete(save=False)
+    delete_unreferenced(document.document, Document, "document")
+    delete_unreferenced(document.thumbnail, Document, "thumbnail")
+    delete_unreferenced(document.fulltext, Document, "fulltext")
 
 
 def upload_image_to(doc, filename):
@@ -595,6 +968,18 @@ def upload_image_to(doc, filename):
     return fmt % (doc.document_id, filename)
 
 
+def thumbnail_name(image_name, size=None):
+    """Storage name of an image's thumbnail at one of the THUMBNAIL_SIZES. The
+    thumbnail at the default size is the one saved to Image.thumbnail.
+    """
+    base, _ = os.path.splitext(os.path.basename(image_name))
+    if size in (None, settings.THUMBNAIL_DEFAULT):
+        prefix = "thumb_"
+    else:
+        prefix = f"thumb_{size}_"
+    return os.path.join(os.path.dirname(image_name), prefix + base + ".jpg")
+
+
 class Image(models.Model):
     """
     An image associated with a proposal and (optionally) with a document.
@@ -617,6 +1002,8 @@ class Image(models.Model):
     priority = models.IntegerField(default=0, db_index=True)
     source = models.CharField(max_length=64, default="document")
     created = models.DateTimeField(default=timezone.now)
+    # Perceptual hash of the image, for finding duplicates (see image_index):
+    phash = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         unique_together = (("proposal", "image"))
@@ -624,21 +1011,33 @@ class Image(models.Model):
     def get_url(self):
         return self.image and self.image.url or self.url
 
+    def thumbnail_names(self):
+        "Returns a dict mapping the THUMBNAIL_SIZES to storage names."
+        return {size: thumbnail_name(self.image.name, size)
+                for size in settings.THUMBNAIL_SIZES}
+
     def to_dict(self):
-        return {
+        d = {
             "id": self.pk,
             "src": self.get_url(),
             "thumb": self.thumbnail.url if self.thumbnail else None
         }
+        # Older thumbnails were generated at a single size:
+        if self.image and self.thumbnail and \
+           self.thumbnail.name == thumbnail_name(self.image.name):
+            d["thumbs"] = {size: default_storage.url(name)
+                           for size, name in self.thumbnail_names().items()}
+        return d
 
 
 @receiver(models.signals.post_delete, sender=Image)
 def auto_delete_image(**kwargs):
     image = kwargs["instance"]
-    if image.image:
-        image.image.delete(save=False)
-    if image.thumbnail:
-        image.thumbnail.delete(save=False)
+    sizes = image.image and image.thumbnail and image.thumbnail_names()
+    delete_unreferenced(image.image, Image, "image")
+    if delete_unreferenced(image.thumbnail, Image, "thumbnail") and sizes:
+        for name in sizes.values():
+            default_storage.delete(name)
 
 
 class Changeset(models.Model):
@@ -684,10 +1083,33 @@ class Changeset(models.Model):
 
 @utils.lazy
 def get_importer_schema():
+    schema_path = settings.IMPORTER_SCHEMA_PATH
+    if schema_path and os.path.exists(schema_path):
+        with open(schema_path, "r") as schema_in:
+            return json.load(schema_in)
+
     with request.urlopen(settings.IMPORTER_SCHEMA) as u_in:
         return json.loads(u_in.read())
 
 
+@utils.lazy
+def get_importer_validators():
+    """Builds the validators for the importer schema once per process.
+
+    :returns: a tuple of (validator, item_validators), where item_validators
+    maps the top-level keys of the schema (cases, events, projects) to
+    validators for the individual items in each list.
+    """
+    schema = get_importer_schema()
+    resolver = jsonschema.RefResolver.from_schema(schema)
+    item_validators = {
+        k: jsonschema.Draft4Validator(prop["items"], resolver=resolver)
+        for k, prop in schema.get("properties", {}).items()
+        if prop.get("type") == "array" and "items" in prop
+    }
+    return jsonschema.Draft4Validator(schema, resolver=resolver), item_validators
+
+
 class Importer(models.Model):
     """Importers are created through the administrator interface. Cornerwise
     will place a GET request to the importer's URL once a day with a `when`
@@ -722,7 +1144,40 @@ class Importer(models.Model):
     def validate(data, schema=None):
         """Validates data against the JSON schema for Cornerwise importers.
         """
-        return jsonschema.validate(data, schema or get_importer_schema())
+        validator = jsonschema.Draft4Validator(schema) if schema else \
+            get_importer_validators()[0]
+        return validator.validate(data)
+
+    @staticmethod
+    def validate_items(data):
+        """Validates each case, event, and project in data individually, so that
+        a few bad records do not cause the whole response to be rejected.
+        Raises a ValidationError if the response is malformed at the top level.
+
+        :returns: a tuple of (valid, errors), where valid is a copy of data
+        with the invalid items removed and errors is a list of (key, index,
+        ValidationError) tuples
+        """
+        validator, item_validators = get_importer_validators()
+        to_check = {k: v for k, v in data.items()
+                    if k in item_validators and isinstance(v, list)} \
+            if isinstance(data, dict) else {}
+        # Check everything except the items themselves:
+        validator.validate(dict(data, **{k: [] for k in to_check}))
+
+        valid = dict(data)
+        errors = []
+        for k, items in to_check.items():
+            valid[k] = []
+            for i, item in enumerate(items):
+                error = jsonschema.exceptions.best_match(
+                    item_validators[k].iter_errors(item))
+                if error:
+                    errors.append((k, i, error))
+                else:
+                    valid[k].append(item)
+
+        return valid, errors
 
     def __str__(self):
         return self.name
@@ -735,8 +1190,8 @@ class Importer(models.Model):
         params = since and {"since": since.strftime("%Y%m%d")}
         return utils.add_params(self.url, params)
 
-    def updated_since(self, when=None):
-        with request.urlopen(self.url_for(when)) as u:
+    def updated_since(self, when=None, timeout=None):
+        with request.urlopen(self.url_for(when), timeout=timeout) as u:
             return json.load(u)
 
     def cases_since(self, when):
@@ -780,3 +1235,88 @@ class Layer(models.Model):
     def calculate_envelope(self):
         gc = utils.geometry_from_url(self.url)
         self.envelope = gc.envelope
+
+
+# Cached query responses include the generation at the time they were cached,
+# so incrementing it makes them all stale.
+QUERY_GENERATION_KEY = "proposal:query_generation"
+
+
+def query_generation():
+    return cache.get_or_set(QUERY_GENERATION_KEY, 1, None)
+
+
+def bump_query_generation(**_):
+    try:
+        cache.incr(QUERY_GENERATION_KEY)
+    except ValueError:
+        cache.set(QUERY_GENERATION_KEY, 1, None)
+
+
+for sender in (Proposal, Attribute, Event):
+    for signal in (models.signals.post_save, models.signals.post_delete):
+        signal.connect(bump_query_generation, sender=sender,
+                       dispatch_uid=f"bump_query_generation_{sender.__name__}")
+
+
+# Documents and Images are saved many times while they are processed, but
+# only changes to these fields appear in query responses:
+OUTPUT_FIELDS = {
+    Document: ("url", "title", "field", "tags", "published", "encoding",
+               "document", "thumbnail"),
+    Image: ("url", "image", "thumbnail", "priority")
+}
+
+
+def output_values(instance):
+    # Deferred fields are not loaded; files are compared by name.
+    return tuple(getattr(value, "name", value) for value in
+                 (instance.__dict__.get(field)
+                  for field in OUTPUT_FIELDS[type(instance)]))
+
+
+def remember_output_values(sender, instance, **_):
+    instance._output_values = output_values(instance)
+
+
+def bump_if_output_changed(sender, instance, created=False, **_):
+    values = output_values(instance)
+    if created or values != getattr(instance, "_output_values", None):
+        bump_query_generation()
+    instance._output_values = values
+
+
+for sender in OUTPUT_FIELDS:
+    name = sender.__name__
+    models.signals.post_init.connect(
+        remember_output_values, sender=sender,
+        dispatch_uid=f"remember_output_values_{name}")
+    models.signals.post_save.connect(
+        bump_if_output_changed, sender=sender,
+        dispatch_uid=f"bump_query_generation_{name}")
+    models.signals.post_delete.connect(
+        bump_query_generation, sender=sender,
+        dispatch_uid=f"bump_query_generation_delete_{name}")
+
+
+@receiver(models.signals.post_init, sender=Proposal)
+def remember_location(sender, instance, **_):
+    # The location when the proposal was loaded, so that moving a proposal
+    # also invalidates the tiles where it was. Deferred locations are not
+    # loaded.
+    instance._tile_location = None \
+        if "location" in instance.get_deferred_fields() else instance.location
+
+
+def bump_proposal_tiles(proposals):
+    tiles.bump_tiles([p for proposal in proposals
+                      for p in (proposal.location,
+                                getattr(proposal, "_tile_location", None))])
+    for proposal in proposals:
+        proposal._tile_location = proposal.location
+
+
+@receiver(models.signals.post_save, sender=Proposal)
+@receiver(models.signals.post_delete, sender=Proposal)
+def proposal_tiles_changed(sender, instance, **_):
+    bump_proposal_tiles([instance])
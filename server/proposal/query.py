@@ -1,14 +1,23 @@
-from django.db.models import Q
+from django.conf import settings
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connection
+from django.db.models import (Count, F, FloatField, IntegerField, OuterRef, Q,
+                              Subquery)
+from django.db.models.expressions import RawSQL
 from django.utils import timezone
 import calendar
-from collections import defaultdict
 from datetime import datetime, timedelta
 from functools import reduce, partial
+import hashlib
+import json
+import math
 import re
 
 from dateutil.parser import parse as parse_date
 
-from .models import Attribute, local_now, localize_dt
+from .models import (Attribute, Document, MAX_INDEXED_CHARS, Proposal,
+                     TEXT_SEARCH_CONFIG, local_now, localize_dt)
 from parcel.models import LotSize, LotQuantiles
 from utils import bounds_from_box, distance_from_str, point_from_str
 
@@ -46,13 +55,22 @@ def make_size_query(param):
         return {size_op: float(m.group(3))}
 
 
+def lot_size_query(param):
+    parcel_query = make_size_query(param)
+    if parcel_query:
+        return LotSize.objects.filter(**parcel_query).values("parcel_id")
+
+
 def run_attributes_query(d):
     """Construct a Proposal query from query parameters.
 
     :param d: A dictionary-like object, typically something like
     request.GET.
 
-    :returns: A
+    :returns: None if `d` has no attr.<handle> parameters. Otherwise, a
+    queryset of the ids of proposals with a visible attribute matching each
+    parameter ('attr.*' matches any attribute). The conditions are combined
+    with GROUP BY ... HAVING, so the ids are never loaded into Python.
     """
     subqueries = []
 
@@ -60,22 +78,104 @@ def run_attributes_query(d):
         if not k.startswith("attr."):
             continue
 
-        if k == "attr.*":
-            subqueries.append(Q(text_value__search=val))
-        else:
-            subqueries.append(Q(handle=k[5:], text_value__search=val))
+        query = Q(text_vector=text_search_query(val))
+        if k != "attr.*":
+            query &= Q(handle=k[5:])
+        subqueries.append(query)
 
     if subqueries:
-        query = reduce(Q.__or__, subqueries, Q())
-        attrs = Attribute.objects.filter(hidden=False)\
-                                 .filter(query)\
-                                 .values("proposal_id", "handle",
-                                         "text_value")
-        attr_maps = defaultdict(int)
-        for attr in attrs:
-            attr_maps[attr["proposal_id"]] += 1
+        matches = {f"match_{i}": Count("pk", filter=query)
+                   for i, query in enumerate(subqueries)}
+        # Uses attribute_text_search_idx
+        return Attribute.objects.filter(hidden=False)\
+                                .annotate(text_vector=SearchVector(
+                                    "text_value", config=TEXT_SEARCH_CONFIG))\
+                                .filter(reduce(Q.__or__, subqueries))\
+                                .values("proposal_id")\
+                                .annotate(**matches)\
+                                .filter(**{f"{name}__gt": 0
+                                           for name in matches})\
+                                .values("proposal_id")
+
+
+def text_search_query(q):
+    return SearchQuery(q, config=TEXT_SEARCH_CONFIG)
+
+
+def matching_documents(q):
+    """Find the Documents whose text matches the search string `q`, annotated
+    with their rank.
+    """
+    query = text_search_query(q)
+    return Document.objects.filter(search_vector=query)\
+                           .annotate(rank=SearchRank(F("search_vector"), query))
+
+
+def rank_by_text(proposals, q):
+    """Annotate each proposal with the rank (`text_rank`) and id
+    (`text_match_id`) of its document that best matches `q`, and order the
+    proposals by rank.
+    """
+    docs = matching_documents(q).filter(proposal=OuterRef("pk"))\
+                                .order_by("-rank")
+    return proposals.annotate(
+        text_rank=Subquery(docs.values("rank")[:1], output_field=FloatField()),
+        text_match_id=Subquery(docs.values("pk")[:1],
+                               output_field=IntegerField())
+    ).order_by("-text_rank")
+
 
-        return [pid for pid, c in attr_maps.items() if c == len(subqueries)]
+# Maximum number of characters of each document sent to ts_headline:
+HEADLINE_CHARS = 5000
+
+
+def headline_text(doc, q):
+    """Find the first page of the document that appears to contain a term of
+    `q`, truncated to HEADLINE_CHARS. The terms are matched loosely, by
+    prefix, and only the indexed part of the text is searched; if no page
+    matches, the first page is used.
+    """
+    terms = [word[:max(4, len(word) - 2)]
+             for word in re.findall(r"\w+", q.lower())]
+    first = None
+    read = 0
+    for page in doc.pages():
+        if first is None:
+            first = page
+        if any(term in page.lower() for term in terms):
+            return page[:HEADLINE_CHARS]
+        read += len(page)
+        if read >= MAX_INDEXED_CHARS:
+            break
+    return (first or "")[:HEADLINE_CHARS]
+
+
+def document_headlines(docs, q):
+    """Generate snippets of the documents' text that show the terms matching
+    `q`. Only the matching page of each document is sent to the database, and
+    all snippets are generated with a single query.
+
+    :returns: a dictionary mapping Document ids to snippets
+    """
+    docs = [doc for doc in docs if doc.fulltext]
+    texts = []
+    for doc in docs:
+        try:
+            texts.append(headline_text(doc, q))
+        except OSError:
+            texts.append("")
+
+    if not texts:
+        return {}
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT ts_headline(%s::regconfig, t, "
+            "                   plainto_tsquery(%s::regconfig, %s)) "
+            "FROM unnest(%s::text[]) WITH ORDINALITY AS u(t, n) ORDER BY n",
+            [TEXT_SEARCH_CONFIG, TEXT_SEARCH_CONFIG, q, texts])
+        return {doc.pk: headline
+                for doc, (headline,) in zip(docs, cursor.fetchall())}
 
 
 def month_range(dt):
@@ -147,15 +247,27 @@ query_params = {
 }
 
 
-def build_proposal_query_dict(d):
+def memoized(memo, key, fn, *args):
+    if memo is None:
+        return fn(*args)
+    if key not in memo:
+        memo[key] = fn(*args)
+    return memo[key]
+
+
+def build_proposal_query_dict(d, memo=None):
     """Constructs the keyword arguments to a Django ORM query from a dict passed in
     by a user, either directly from a request or from a saved query, such as a
     Subscription. All keys and values in the dict are expected to be strings.
 
+    If `memo` is a dict, the attribute, time and lot size subqueries are
+    stored in it, and reused by later calls with the same parameters.
+
     Keys considered:
 
     - id: comma-separated Proposal pks
-    - text
+    - text: address substring
+    - q: full text search of the proposal's documents
     - region
     - month - date string
     - start[/end] - date strings
@@ -169,7 +281,9 @@ def build_proposal_query_dict(d):
     subqueries = {}
     defaults = {"status": "active"}
 
-    ids = run_attributes_query(d)
+    attr_params = tuple(sorted((k, v) for k, v in d.items()
+                               if k.startswith("attr.")))
+    ids = memoized(memo, ("attributes", attr_params), run_attributes_query, d)
 
     if ids is not None:
         defaults["status"] = "all"
@@ -177,11 +291,15 @@ def build_proposal_query_dict(d):
     if "id" in d:
         defaults["status"] = "all"
         pids = re.split(r"\s*,\s*", d["id"])
-        ids = pids if ids is None else [id for id in pids if id in set(ids)]
+        ids = pids if ids is None else ids.filter(proposal_id__in=pids)
 
     if "text" in d:
         subqueries["address__icontains"] = d["text"]
 
+    if d.get("q"):
+        # pk__in may be used by the id and attribute queries
+        subqueries["id__in"] = matching_documents(d["q"]).values("proposal_id")
+
     if d.get("region"):
         regions = re.split(r"\s*;\s*", d["region"])
         subqueries["region_name__in"] = regions
@@ -189,7 +307,10 @@ def build_proposal_query_dict(d):
     if ids is not None:
         subqueries["pk__in"] = ids
 
-    (start_date, end_date) = time_query(d)
+    time_params = tuple(d.get(k) for k in
+                        ("region", "month", "start", "end", "timerange"))
+    (start_date, end_date) = memoized(memo, ("time", time_params),
+                                      time_query, d)
     if start_date:
         subqueries["started__gte"] = start_date
     if end_date:
@@ -202,9 +323,9 @@ def build_proposal_query_dict(d):
             subqueries["project__isnull"] = False
 
     if "lotsize" in d:
-        parcel_query = make_size_query(d["lotsize"])
-        if parcel_query:
-            parcel_ids = LotSize.objects.filter(**parcel_query).values("parcel_id")
+        parcel_ids = memoized(memo, ("lotsize", d["lotsize"]),
+                              lot_size_query, d["lotsize"])
+        if parcel_ids is not None:
             subqueries["parcel_id__in"] = parcel_ids
 
     if "parcel" in d:
@@ -236,11 +357,79 @@ def build_proposal_query_dict(d):
     return subqueries
 
 
+def snap_box(box, grid=None):
+    """Expand a box (latMin,longMin,latMax,longMax) outward to the nearest grid
+    lines, so that nearly identical boxes produce the same query.
+    """
+    grid = grid or settings.QUERY_BOX_GRID
+    lat_min, lng_min, lat_max, lng_max = map(float, box.split(","))
+    snapped = (math.floor(lat_min / grid) * grid,
+               math.floor(lng_min / grid) * grid,
+               math.ceil(lat_max / grid) * grid,
+               math.ceil(lng_max / grid) * grid)
+    return ",".join("{:.6f}".format(coord) for coord in snapped)
+
+
+# Parameters that affect only how a response is rendered:
+PRESENTATION_PARAMS = {"callback", "format"}
+
+
+def canonical_query(d):
+    """Normalize a QueryDict so that requests for the same results share cache
+    keys. The box, if any, is snapped to the grid.
+
+    :returns: a tuple of the normalized QueryDict and a digest of it
+    """
+    d = d.copy()
+    if d.get("box"):
+        try:
+            d["box"] = snap_box(d["box"])
+        except ValueError:
+            pass
+
+    items = sorted((k, sorted(v)) for k, v in d.lists()
+                   if k not in PRESENTATION_PARAMS)
+    digest = hashlib.sha1(json.dumps(items).encode()).hexdigest()
+    return d, digest
+
+
 def build_proposal_query(d):
     subqueries = build_proposal_query_dict(d)
     return Q(**subqueries)
 
 
+def build_multi_query(dicts):
+    """Construct a query for proposals matching any of several query dicts,
+    such as a user's saved areas.
+
+    Rather than ORing the parts together, which Postgres plans poorly when
+    there are many of them, filters that are identical in every part are
+    applied once, and the remaining filters of each part are run as separate
+    scans whose ids are combined with UNION. Attribute, time and lot size
+    subqueries are only built once for each distinct set of parameters.
+    """
+    memo = {}
+    parts = [build_proposal_query_dict(d, memo) for d in dicts]
+    if len(parts) == 1:
+        return Q(**parts[0])
+
+    shared = {k: v for k, v in parts[0].items()
+              if all(k in part and part[k] == v for part in parts[1:])}
+    scans = []
+    scan_params = []
+    for part in parts:
+        rest = {k: v for k, v in part.items() if k not in shared}
+        if not rest:
+            # This part matches everything that the shared filters do
+            return Q(**shared)
+        sql, params = Proposal.objects.filter(**rest).order_by()\
+                                      .values("pk").query.sql_with_params()
+        scans.append(f"({sql})")
+        scan_params.extend(params)
+
+    return Q(pk__in=RawSQL(" UNION ".join(scans), scan_params), **shared)
+
+
 def build_event_query(d):
     subqueries = {}
     if "region" in d:
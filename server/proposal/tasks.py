@@ -1,29 +1,36 @@
 """Celery tasks for import and processing of Proposals, Events, and Projects
 and their related models (Documents, Images).
 """
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import os
 import re
 from typing import Iterable
+import unicodedata
 
+from billiard import Pool
 import celery
 import jsonschema
 import pytz
+import requests
 
 from django.conf import settings
 from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.dispatch import receiver
-from django.db.models import F
+from django.db.models import F, Func, Value
 from django.db.models.signals import post_save
 from django.db.utils import DataError, IntegrityError
 
 from cornerwise.adapt import adapt
+from redis_utils import Redis
 from utils import add_locations
 from scripts import foursquare, images, street_view, vision
 from shared.geocoder import Geocoder
 from shared.logger import get_logger, task_logger
 from .models import Proposal, Document, Event, Image, Importer
-from . import extract, documents as doc_utils
+from . import extract, image_index, documents as doc_utils
 
 
 shared_task = celery.shared_task
@@ -68,7 +75,12 @@ def fetch_document(self, doc: Document, logger=None):
     url = doc.url
 
     logger.info("Fetching Document #%i", doc.pk)
-    dl, status, updated = doc_utils.save_from_url(doc, url, "download")
+    try:
+        dl, status, updated = doc_utils.save_from_url(doc, url, "download")
+    except requests.RequestException as err:
+        logger.warning("Attempt to download document #%i (%s) failed: %s",
+                       doc.pk, doc.url, err)
+        raise DocumentDownloadException() from err
     if dl:
         if status == 304:
             logger.info("Document #%i is up to date", doc.pk)
@@ -104,10 +116,11 @@ def extract_text(self, doc: Document, logger=None):
 
     """
     logger = logger or get_logger(self)
-    if doc_utils.extract_text(doc):
+    result = doc_utils.extract_text(doc)
+    if result:
         logger.info("Extracted text from Document #%i to %s.", doc.pk,
                     doc.fulltext)
-        return True
+        return result
     else:
         logger.error("Failed to extract text from %s", doc.local_path)
 
@@ -129,6 +142,9 @@ def extract_images(doc: Document, logger=task_logger):
         logger.info("Extracting images from Document #%s", doc.pk)
         images = doc_utils.save_images(doc)
         logger.info("Extracted %i image(s) from %s.", len(images), doc.title)
+        others = doc.proposal.images.exclude(pk__in=[i.pk for i in images])\
+                                    .exclude(phash__isnull=True)
+        images = image_index.collapse_duplicates(images, others)
 
         return [image.pk for image in images]
     except Exception as exc:
@@ -228,19 +244,38 @@ def generate_doc_thumbnail(doc: Document, logger=task_logger):
     return doc_utils.generate_thumbnail(doc)
 
 
+def thumbnail_paths(image):
+    return {size: default_storage.path(name)
+            for size, name in image.thumbnail_names().items()}
+
+
+def has_thumbnail(image):
+    return image.thumbnail and os.path.exists(image.thumbnail.path)
+
+
+def save_thumbnail(image):
+    image.thumbnail.name = image.thumbnail_names()[settings.THUMBNAIL_DEFAULT]
+    image.save(update_fields=["thumbnail"])
+
+
 @shared_task
 def generate_thumbnail(image_id, replace=False, logger=task_logger,
                        force=False):
-    """Generate an image thumbnail.
+    """Generate thumbnails of an image at each of the THUMBNAIL_SIZES.
 
     :param image: A proposal.model.Image object with a corresponding
     image file on the local filesystem.
 
     :returns: Thumbnail path"""
 
-    image = Image.objects.get(pk=image_id)
-    thumbnail_path = image.thumbnail and image.thumbnail.name
-    if not force and thumbnail_path and os.path.exists(thumbnail_path):
+    try:
+        image = Image.objects.get(pk=image_id)
+    except Image.DoesNotExist:
+        logger.info("Image #%s was deleted before thumbnail generation",
+                    image_id)
+        return
+
+    if not force and has_thumbnail(image):
         logger.info("Thumbnail already exists (%s)", image.thumbnail.name)
     else:
         if not image.image:
@@ -248,19 +283,49 @@ def generate_thumbnail(image_id, replace=False, logger=task_logger,
             return
 
         try:
-            image_path = image.image.path
-            thumbnail = images.image_data(
-                images.make_thumbnail(image_path, fit=settings.THUMBNAIL_DIM))
+            images.write_thumbnails(image.image.path, settings.THUMBNAIL_SIZES,
+                                    thumbnail_paths(image))
         except Exception as err:
             logger.error(err)
             return
 
-        thumbnail_path = images.thumbnail_name(image_path)
-        image.thumbnail.save(thumbnail_path, thumbnail)
+        save_thumbnail(image)
         logger.info("Generated thumbnail for Image #%i: %s", image.pk,
-                    thumbnail_path)
+                    image.thumbnail.name)
+
+    return image.thumbnail.name
+
+
+@shared_task
+def generate_thumbnails(image_ids, logger=task_logger, force=False):
+    """Generate the thumbnails for several images, using a pool of
+    THUMBNAIL_PROCESSES processes.
+    """
+    todo = [image for image in Image.objects.filter(pk__in=image_ids)
+            if image.image and (force or not has_thumbnail(image))]
+    if not todo:
+        return
 
-    return thumbnail_path
+    pool = Pool(min(settings.THUMBNAIL_PROCESSES, len(todo)))
+    try:
+        results = [pool.apply_async(images.write_thumbnails,
+                                     (image.image.path,
+                                      settings.THUMBNAIL_SIZES,
+                                      thumbnail_paths(image)))
+                   for image in todo]
+        for image, result in zip(todo, results):
+            try:
+                result.get()
+            except Exception as err:
+                logger.error("Thumbnail generation failed for Image #%i: %s",
+                             image.pk, err)
+                continue
+            save_thumbnail(image)
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info("Generated thumbnails for %i image(s)", len(todo))
 
 
 @shared_task
@@ -273,49 +338,83 @@ def add_doc_attributes(doc: Document, logger=task_logger):
     return doc.pk
 
 
-@shared_task
-def generate_thumbnails(image_ids, logger=task_logger):
-    for image_id in image_ids:
-        try:
-            generate_thumbnail(image_id, logger=task_logger)
-        except Image.DoesNotExist:
-            logger.info(
-                f"Image #{image_id} was deleted before thumbnail generation"
-            )
-            continue
-
-
 @shared_task
 @adapt
 def save_image_text(doc: Document, image_ids, logger=task_logger):
+    """Append the text found in the document's images to its text as a final
+    page. The page is only added once, even if the task is run again.
+    """
     if not len(image_ids):
         return
 
     all_text = [t for t in [cache.get(f"image:{image_id}:text")
                             for image_id in image_ids] if t]
 
-    if all_text:
-        text_path = os.path.join(os.path.dirname(doc.local_path), "text.txt")
-        with open(text_path, "a") as fulltext:
-            for text in all_text:
-                fulltext.write(text)
-                fulltext.write("\n")
-        doc.encoding = "utf-8"
-        doc.fulltext = text_path
-        doc.save()
-
-
-@shared_task
-@adapt
-def post_process_images(doc: Document, image_ids, logger=task_logger):
-    logger.info(
-        f"Post processing image ids {image_ids} for doc {doc.pk}")
-    for image_id in image_ids:
-        cloud_vision_process(image_id, logger)
-    generate_thumbnails(image_ids, logger)
-    save_image_text(doc.id, image_ids, logger)
+    if not all_text or not mark_stage_done(doc.pk, "image_text"):
+        return
 
-    return image_ids
+    try:
+        text_path = doc_utils.own_text_file(doc)
+        # The image text is added as a final page, in the file's encoding:
+        page = unicodedata.normalize("NFC", "\n".join(all_text) + "\n\f")
+        with open(text_path, "ab") as fulltext:
+            fulltext.write(page.encode(doc.encoding or "utf-8", "replace"))
+            size = fulltext.tell()
+    except Exception:
+        reset_stages(doc.pk, ["image_text"])
+        raise
+
+    if doc.page_offsets:
+        doc.page_offsets.append(size)
+    doc.save()
+    doc_utils.append_index_text(doc, page)
+
+
+# Document processing pipeline
+#
+# Each stage of document processing runs as a separate task, routed to a queue
+# according to the kind of work it does (see CELERY_ROUTES in settings). When
+# a stage completes, it is added to the Document's completed_stages, so that a
+# retried or repeated run skips the stages that have already finished.
+DOCUMENT_STAGES = ("fetch", "text", "attributes", "images", "image_text",
+                   "thumbnail")
+# The results of these stages can be copied from a document with the same
+# contents:
+COPIED_STAGES = ("text", "images", "thumbnail")
+
+
+def stages_expression(function, stages):
+    # Stages run concurrently, so the array is modified in the UPDATE rather
+    # than read and written back.
+    expression = F("completed_stages")
+    for stage in stages:
+        expression = Func(
+            expression, Value(stage), function=function,
+            output_field=Document._meta.get_field("completed_stages"))
+    return expression
+
+
+def stage_done(doc_id, stage):
+    return Document.objects.filter(pk=doc_id,
+                                   completed_stages__contains=[stage])\
+                           .exists()
+
+
+def mark_stage_done(doc_id, stage):
+    """:returns: True if the stage was not already done"""
+    return bool(
+        Document.objects.filter(pk=doc_id)
+        .exclude(completed_stages__contains=[stage])
+        .update(completed_stages=stages_expression("array_append", [stage])))
+
+
+def reset_stages(doc_id, stages=DOCUMENT_STAGES):
+    Document.objects.filter(pk=doc_id)\
+                    .update(completed_stages=stages_expression(
+                        "array_remove", stages))
+    if "images" in stages:
+        cache.delete(f"doc:{doc_id}:image_ids")
+        Redis.delete(vision_pending_key(doc_id))
 
 
 @shared_task(autoretry_for=(DocumentDownloadException,),
@@ -324,21 +423,106 @@ def post_process_images(doc: Document, image_ids, logger=task_logger):
              on_failure=document_processing_failed,
              bind=True)
 @adapt
-def process_document(self, doc: Document):
+def fetch_document_stage(self, doc: Document):
     logger = get_logger(self)
     updated, _ = fetch_document(doc, logger)
 
-    extracted = (not updated and doc.fulltext) or \
-        extract_text(doc, logger)
+    if updated:
+        # The contents have changed, so everything downstream must be redone:
+        reset_stages(doc.pk)
+
+        source = doc_utils.find_processed_copy(doc, COPIED_STAGES)
+        if source:
+            images = doc_utils.copy_processed(doc, source)
+            logger.info("Document #%i has the same contents as #%i; copied "
+                        "text, thumbnail, and %i image(s)",
+                        doc.pk, source.pk, len(images))
+            for stage in COPIED_STAGES:
+                mark_stage_done(doc.pk, stage)
+    mark_stage_done(doc.pk, "fetch")
 
-    if extracted:
-        add_doc_attributes(doc, logger)
 
-        image_ids = extract_images(doc, logger)
-        post_process_images(doc, image_ids, logger)
+@shared_task(bind=True)
+@adapt
+def extract_text_stage(self, doc: Document):
+    if stage_done(doc.pk, "text") and doc.fulltext:
+        return
 
-    if updated or not doc.thumbnail:
-        generate_doc_thumbnail(doc, logger)
+    result = extract_text(doc, get_logger(self))
+    if result:
+        mark_stage_done(doc.pk, "text")
+        if result.get("thumbnail"):
+            mark_stage_done(doc.pk, "thumbnail")
+
+
+@shared_task(bind=True)
+@adapt
+def add_doc_attributes_stage(self, doc: Document):
+    if stage_done(doc.pk, "attributes") or not stage_done(doc.pk, "text"):
+        return
+
+    add_doc_attributes(doc, get_logger(self))
+    mark_stage_done(doc.pk, "attributes")
+
+
+@shared_task(bind=True)
+@adapt
+def extract_images_stage(self, doc: Document):
+    """Extract the document's images, then queue them to be classified along
+    with the images of other documents and thumbnailed. The ids of the
+    extracted images are stored, so if the stage is run again before the
+    images have all been processed, extraction is skipped.
+    """
+    if stage_done(doc.pk, "images") or not stage_done(doc.pk, "text"):
+        return
+
+    ids_key = f"doc:{doc.pk}:image_ids"
+    image_ids = cache.get(ids_key)
+    if image_ids is None:
+        image_ids = extract_images(doc, get_logger(self))
+        # Kept until the images stage finishes or the stages are reset
+        cache.set(ids_key, image_ids, timeout=None)
+
+    if not image_ids:
+        finish_images_stage(doc.pk, image_ids)
+        return
+
+    if not queue_vision_processing(doc.pk, image_ids):
+        get_logger(self).info("Images of Document #%i are already queued",
+                              doc.pk)
+
+
+@shared_task(bind=True)
+@adapt
+def finish_images_stage(self, doc: Document, image_ids):
+    save_image_text(doc, image_ids, get_logger(self))
+    mark_stage_done(doc.pk, "images")
+    cache.delete(f"doc:{doc.pk}:image_ids")
+
+
+@shared_task(bind=True)
+@adapt
+def generate_doc_thumbnail_stage(self, doc: Document):
+    if stage_done(doc.pk, "thumbnail") and doc.thumbnail:
+        return
+
+    generate_doc_thumbnail(doc, get_logger(self))
+    mark_stage_done(doc.pk, "thumbnail")
+
+
+@shared_task
+def process_document(doc_id):
+    """Start the processing pipeline for a Document. After the document is
+    fetched and its text extracted, attribute extraction, image processing,
+    and thumbnail generation proceed in parallel.
+    """
+    return celery.chain(
+        fetch_document_stage.si(doc_id),
+        extract_text_stage.si(doc_id),
+        celery.group(add_doc_attributes_stage.si(doc_id),
+                     extract_images_stage.si(doc_id),
+                     generate_doc_thumbnail_stage.si(doc_id))
+    ).delay()
 
 
 def process_proposal(proposal, logger=task_logger):
@@ -359,20 +543,13 @@ def stringify_address_dict(address):
 def create_proposals(dicts, logger=task_logger):
     """Helper function to create new Proposal objects.
     """
+    def log_failure(case_dict, exc):
+        logger.error("Could not create proposal from dictionary: %s",
+                     case_dict, exc_info=exc)
 
-    for case_dict in dicts:
-        try:
-            (_, p) = Proposal.create_or_update_from_dict(case_dict)
-            p.importer = case_dict.get("importer")
-            p.save()  # Needed?
-            yield p
-        except Exception as exc:
-            import pprint
-            from io import StringIO
-            buff = StringIO()
-            pprint.pprint(case_dict, buff)
-            logger.exception("Could not create proposal from dictionary: %s",
-                             case_dict)
+    for (_, p) in Proposal.create_or_update_from_dicts(dicts,
+                                                       on_error=log_failure):
+        yield p
 
 
 def create_events(dicts, logger=task_logger):
@@ -384,11 +561,61 @@ def create_projects(dicts):
     pass
 
 
+def since_for_importer(importer, since, default_since):
+    """Determine the start date to send to an importer.
+    """
+    importer_since = since
+    if not since:
+        if importer.last_run:
+            importer_since = importer.last_run
+        else:
+            importer_since = default_since
+
+    return importer.tz.normalize(importer_since) if importer_since.tzinfo \
+        else importer_since
+
+
+def run_importer(importer, since, timeout=None):
+    """Fetch and validate the results from a single importer. Safe to run outside
+    of the main thread, since it does not touch the database.
+
+    :returns: a tuple of (found, errors); see Importer.validate_items
+    """
+    return importer.validate_items(importer.updated_since(since, timeout=timeout))
+
+
+def save_found(importer, found, now, logger=task_logger):
+    """Geocode and store the cases and events returned by an importer.
+
+    :returns: a tuple of (proposal ids, event ids)
+    """
+    found_description = ", ".join(f"{len(v)} {k}" for k, v in found.items())
+    logger.info(f"Fetched: {found_description} w/{importer}")
+
+    for k in found:
+        for item in found[k]:
+            item.setdefault("region_name", importer.region_name)
+            item["importer"] = importer
+
+    cases = found.get("cases", [])
+    add_locations(cases, Geocoder)
+
+    proposal_ids = [p.id for p in create_proposals(cases, logger)]
+    event_ids = [event.id for event in
+                 create_events(found.get("events", []), logger)]
+
+    importer.last_run = now
+    importer.save()
+
+    return proposal_ids, event_ids
+
+
 @adapt
 def fetch_proposals(since: datetime=None,
                     importers: Iterable[Importer]=None,
                     logger=task_logger):
-    """Task runs each of the importers given.
+    """Task runs each of the importers given. The importers are fetched
+    concurrently, and the results from each are stored as soon as they arrive.
 
     """
     now = pytz.utc.localize(datetime.utcnow().replace(hour=0, minute=8,
@@ -405,48 +632,50 @@ def fetch_proposals(since: datetime=None,
     if importers is None:
         importers = Importer.objects.all()
 
-    all_found = {"cases": [], "events": [], "projects": []}
-    for importer in importers:
-        importer_since = since
-        if not since:
-            if importer.last_run:
-                importer_since = importer.last_run
-            else:
-                importer_since = default_since
-
-        importer_since = \
-            importer.tz.normalize(importer_since) if importer_since.tzinfo \
-            else importer_since
-
-        try:
-            found = importer.updated_since(importer_since)
-            importer.validate(found)
-        except jsonschema.exceptions.ValidationError as err:
-            logger.warning("Importer %s failed schema validation!\n%s",
-                           importer.name, err)
-            continue
-        except Exception as err:
-            logger.exception("An unknown error occurred while running importer %s",
-                             importer.name)
-            continue
-
-        found_description = ", ".join(f"{len(v)} {k}" for k, v in found.items())
-        logger.info(f"Fetched: {found_description} w/{importer}")
-
-        for k in found:
-            for item in found[k]:
-                item.setdefault("region_name", importer.region_name)
-                item["importer"] = importer
-                all_found[k].append(item)
-
-        importer.last_run = now
-        importer.save()
-
-    add_locations(all_found["cases"], Geocoder)
+    proposal_ids = []
+    event_ids = []
+    with ThreadPoolExecutor(max_workers=settings.IMPORTER_CONCURRENCY) as pool:
+        futures = {
+            pool.submit(run_importer, importer,
+                        since_for_importer(importer, since, default_since),
+                        settings.IMPORTER_TIMEOUT): importer
+            for importer in importers
+        }
+
+        # Database writes happen on this thread as each importer finishes:
+        for future in as_completed(futures):
+            importer = futures[future]
+            try:
+                found, errors = future.result()
+            except jsonschema.exceptions.ValidationError as err:
+                logger.warning("Importer %s failed schema validation!\n%s",
+                               importer.name, err)
+                continue
+            except Exception as err:
+                logger.error("An unknown error occurred while running importer %s",
+                             importer.name, exc_info=err)
+                continue
+
+            if errors:
+                logger.warning("Importer %s returned %i invalid item(s)",
+                               importer.name, len(errors))
+                for (k, i, err) in errors:
+                    logger.warning("%s[%i]: %s", k, i, err.message)
+
+            try:
+                new_proposal_ids, new_event_ids = \
+                    save_found(importer, found, now, logger)
+            except Exception as err:
+                logger.error("Failed to save results from importer %s",
+                             importer.name, exc_info=err)
+                continue
+
+            proposal_ids.extend(new_proposal_ids)
+            event_ids.extend(new_event_ids)
 
     return {
-        "proposal_ids": [p.id for p in create_proposals(all_found["cases"], logger)],
-        "event_ids": [event.id for event in create_events(all_found["events"], logger)]
+        "proposal_ids": proposal_ids,
+        "event_ids": event_ids
     }
 
 
@@ -467,40 +696,192 @@ def pull_updates(self, since: datetime=None, importers_filter={}):
 
 
 # Image tasks
-@shared_task
-def cloud_vision_process(image_id, logger=task_logger):
-    """
-    Send the image to the Cloud Vision API. If the image is recognized as a
-    logo, delete it.
+def known_classification(image, logger=task_logger):
+    """Look for an earlier Cloud Vision result for the image: either its own, or
+    that of an image that closely resembles it, such as a logo.
+
+    :returns: a tuple of the image's perceptual hash and the result (or None)
     """
-    processed_key = f"image:{image_id}:checked"
-    image = Image.objects.annotate(region_name=F("proposal__region_name"))\
-                         .get(pk=image_id)
-    if cache.get(processed_key):
-        return
+    processed = cache.get(f"image:{image.pk}:vision")
+    phash = image_index.image_hash(image)
+    if not processed and phash is not None:
+        processed = image_index.lookup(phash)
+        if processed:
+            logger.info("Image #%i matches a classified image", image.pk)
+
+    return phash, processed
+
+
+def save_classification(image, phash, processed):
+    cache.set(f"image:{image.pk}:vision", processed,
+              settings.VISION_RESULT_TTL)
+    if phash is not None:
+        image_index.add(phash, processed)
+
 
-    city_name = re.split(r"\s*,\s*", image.region_name, 1)[0]
-    processed = vision.process_image(image.image and image.image.path, image.url)
+def apply_classification(image, processed, logger=task_logger):
+    """Delete the image if it is a logo, an empty street view, or mostly text.
+    Save its text, if any, to be added to the document's text.
+    """
+    image_id = image.pk
     if processed:
+        if "text" in processed:
+            cache.set(f"image:{image_id}:text", processed["text"],
+                      settings.VISION_RESULT_TTL)
+
         logo = processed["logo"]
-        if logo:
-            if city_name in logo["description"]:
-                image.delete()
-                logger.info("Logo detected: image #%i deleted", image_id)
-            else:
-                cache.set(f"image:{image_id}:logo", logo)
-
-        if processed["empty_streetview"]:
+        city_name = re.split(r"\s*,\s*", image.region_name, 1)[0]
+        if logo and city_name in logo["description"]:
+            image.delete()
+            logger.info("Logo detected: image #%i deleted", image_id)
+        elif processed["empty_streetview"]:
             image.delete()
             logger.info("Empty streetview: image #%i deleted", image_id)
-
-        if processed["textual"]:
+        elif processed["textual"]:
             image.delete()
+        elif logo:
+            cache.set(f"image:{image_id}:logo", logo,
+                      settings.VISION_RESULT_TTL)
+
+        cache.set(f"image:{image_id}:checked", True,
+                  settings.VISION_RESULT_TTL)
+
+
+# Images waiting to be sent to Cloud Vision are queued (as "<doc id>:<image
+# id>:<failed attempts>") so that images from several documents can share
+# requests.
+VISION_QUEUE = "cornerwise:vision:pending"
+VISION_SCHEDULED_KEY = "cornerwise:vision:scheduled"
+
+
+def vision_pending_key(doc_id):
+    return f"cornerwise:vision:doc:{doc_id}:pending"
+
+
+def schedule_vision_batch(countdown):
+    # Only one batch is scheduled at a time:
+    if Redis.set(VISION_SCHEDULED_KEY, 1, nx=True, ex=60*60):
+        process_pending_images.apply_async(countdown=countdown)
+
+
+def queue_vision_processing(doc_id, image_ids):
+    """Add a document's images to the Cloud Vision queue. After they have all
+    been classified and thumbnailed, the images stage of the document is
+    finished.
+
+    :returns: False if the document's images were already queued and have not
+    all been processed, in which case they are not queued again
+    """
+    if not Redis.set(vision_pending_key(doc_id), len(image_ids), nx=True):
+        return False
+    Redis.rpush(VISION_QUEUE, *(f"{doc_id}:{image_id}:0"
+                                for image_id in image_ids))
+    schedule_vision_batch(settings.VISION_BATCH_DELAY)
+    return True
 
-        if "text" in processed:
-            cache.set(f"image:{image_id}:text", processed["text"])
 
-    cache.set(processed_key, True)
+@shared_task
+def process_pending_images(logger=task_logger):
+    """Classify queued images, sending as many images per Cloud Vision request
+    as possible. Images with a known classification are handled without an
+    API call.
+
+    Images whose classification fails are queued again, up to
+    VISION_MAX_ATTEMPTS times. After that, they are thumbnailed without
+    being classified, so that their documents can still finish processing.
+    """
+    limit = settings.VISION_BATCH_SIZE * settings.VISION_CONCURRENCY
+    with Redis.pipeline() as p:
+        p.lrange(VISION_QUEUE, 0, limit-1)
+        p.ltrim(VISION_QUEUE, limit, -1)
+        entries, _ = p.execute()
+
+    Redis.delete(VISION_SCHEDULED_KEY)
+    if Redis.llen(VISION_QUEUE):
+        schedule_vision_batch(0)
+
+    queued = []
+    for entry in entries:
+        doc_id, image_id, *attempts = map(int, entry.decode().split(":"))
+        queued.append((doc_id, image_id, attempts[0] if attempts else 0))
+
+    try:
+        failed = set(classify_images([image_id for _, image_id, _ in queued],
+                                     logger))
+    except Exception:
+        logger.exception("Failed to classify %i image(s)", len(queued))
+        failed = {image_id for _, image_id, _ in queued}
+
+    retry = [(doc_id, image_id, attempts + 1)
+             for doc_id, image_id, attempts in queued
+             if image_id in failed and
+             attempts + 1 < settings.VISION_MAX_ATTEMPTS]
+    if retry:
+        Redis.rpush(VISION_QUEUE, *(":".join(map(str, item))
+                                    for item in retry))
+        schedule_vision_batch(settings.VISION_BATCH_DELAY)
+        logger.warning("%i image(s) could not be classified; queued again",
+                       len(retry))
+        retried = {(doc_id, image_id) for doc_id, image_id, _ in retry}
+        queued = [item for item in queued if item[:2] not in retried]
+
+    doc_images = defaultdict(list)
+    for doc_id, image_id, _ in queued:
+        doc_images[doc_id].append(image_id)
+
+    if doc_images:
+        # The images of every document in the batch are thumbnailed together,
+        # by a pool of processes:
+        celery.chain(
+            generate_thumbnails.si([image_id for _, image_id, _ in queued]),
+            celery.group(images_processed.si(doc_id, len(image_ids))
+                         for doc_id, image_ids in doc_images.items())
+        ).delay()
+
+
+def classify_images(image_ids, logger=task_logger):
+    """Classify images that have not yet been checked, sending as many as
+    possible in each Cloud Vision request.
+
+    :returns: the ids of the images whose Cloud Vision requests failed
+    """
+    images = Image.objects.annotate(region_name=F("proposal__region_name"))\
+                          .in_bulk(image_ids)
+    classify = []
+    for image in images.values():
+        if cache.get(f"image:{image.pk}:checked"):
+            continue
+        phash, processed = known_classification(image, logger)
+        if processed:
+            apply_classification(image, processed, logger)
+        else:
+            classify.append((image, phash))
+
+    if not classify:
+        return []
+
+    logger.info("Sending %i image(s) to Cloud Vision", len(classify))
+    results, failed = vision.process_images(
+        [(image.image and image.image.path, image.url)
+         for image, _ in classify],
+        batch_size=settings.VISION_BATCH_SIZE,
+        concurrency=settings.VISION_CONCURRENCY)
+    for (image, phash), processed in zip(classify, results):
+        if processed:
+            save_classification(image, phash, processed)
+            apply_classification(image, processed, logger)
+
+    return [classify[i][0].pk for i in failed]
+
+
+@shared_task
+def images_processed(doc_id, count):
+    "Finish the images stage of a document once all its images are processed."
+    if Redis.decrby(vision_pending_key(doc_id), count) <= 0:
+        # The pending key is kept until the stage is marked done, so that the
+        # images are not queued again in the meantime.
+        finish_images_stage(doc_id, cache.get(f"doc:{doc_id}:image_ids", []))
+        Redis.delete(vision_pending_key(doc_id))
 
 
 @receiver(post_save, sender=Proposal, dispatch_uid="process_new_proposal")
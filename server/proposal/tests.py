@@ -1,15 +1,29 @@
+import hashlib
 import os
 from datetime import datetime, timedelta
 from pprint import pprint
+import tempfile
+from unittest import mock
 
 from django.conf import settings
-from django.test import TestCase, tag
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.http import QueryDict
+from django.test import TestCase, override_settings, tag
+from PyPDF2 import PdfFileWriter
+import pytz
+import requests
 
-from proposal.models import Importer, Proposal
-from scripts import gmaps
+from proposal.models import Document, Importer, Proposal, query_generation
+from scripts import gmaps, pdf
+from shared.tests import image_stream, write_pdf
 from utils import add_locations
 
-from . import extract, tasks
+from . import documents, extract, image_index, tasks, tiles
+from .query import build_multi_query, canonical_query, run_attributes_query
+from .views import cursor_page, proposal_json, proposals_json
 
 proposal_dict = {'all_addresses': ['21 Cherry Street'],
                  'case_number': 'ZBA 2017-123',
@@ -119,10 +133,368 @@ class TestImport(TestCase):
         self.assertIn("Applicant Name", changed_attribute_names)
         self.assertIn("description", changed_property_names)
 
+    def test_create_from_dicts(self):
+        pdict = proposal_dict_with_location.copy()
+        pdict["attributes"] = list(pdict["attributes"])
+        ((created, proposal),) = Proposal.create_or_update_from_dicts([pdict])
+        self.assertTrue(created)
+        self.assertEqual(proposal.attribute_dict["Applicant Name"],
+                         "Sally Bobson")
+
+        pdict["attributes"].append(("Applicant Name", "Darth Vader"))
+        ((created, proposal),) = Proposal.create_or_update_from_dicts([pdict])
+        self.assertFalse(created)
+        self.assertEqual(proposal.attribute_dict["Applicant Name"],
+                         "Darth Vader")
+        changes = proposal.changesets.get().changes
+        self.assertIn("Applicant Name",
+                      [c["name"] for c in changes["attributes"]])
+
     def tearDown(self):
         Proposal.objects.all().delete()
 
 
+@tag("proposal", "import")
+class TestValidation(TestCase):
+    def test_validate_items(self):
+        good_case = {"case_number": "ZBA 2017-123",
+                     "all_addresses": ["21 Cherry Street"],
+                     "updated_date": "2017-10-02T11:49:00-04:00"}
+        bad_case = {"case_number": "ZBA 2017-124"}
+        valid, errors = Importer.validate_items(
+            {"cases": [good_case, bad_case]})
+        self.assertEqual(valid["cases"], [good_case])
+        self.assertEqual([(k, i) for k, i, _ in errors], [("cases", 1)])
+
+
+@tag("proposal", "images")
+class TestImageIndex(TestCase):
+    def test_hash_conversion(self):
+        for phash in (0, 1, 2**63 - 1, 2**63, 2**64 - 1):
+            signed = image_index.to_signed(phash)
+            self.assertTrue(-2**63 <= signed < 2**63)
+            self.assertEqual(image_index.from_signed(signed), phash)
+
+    def test_bands(self):
+        phash = 0x0123456789abcdef
+        near = phash ^ 0b1000000100000010000001
+        self.assertEqual(len(image_index.bands(phash)), image_index.BANDS)
+        self.assertTrue(set(enumerate(image_index.bands(phash))) &
+                        set(enumerate(image_index.bands(near))))
+
+    def test_text_not_shared(self):
+        phash = 0x0123456789abcdef
+        image_index.add(phash, {"logo": {"description": "Somerville"},
+                                "textual": False, "empty_streetview": False,
+                                "text": "City of Somerville"})
+        classification = image_index.lookup(phash ^ 1)
+        self.assertEqual(classification["logo"],
+                         {"description": "Somerville"})
+        self.assertNotIn("text", classification)
+
+    def test_similar_text_pages(self):
+        now = datetime.now(pytz.utc)
+        proposal = Proposal.objects.create(
+            case_number="ZBA 2017-1", case_numbers=["ZBA 2017-1"],
+            address="1 Cherry Street", location=Point(-71.08, 42.37),
+            region_name="Somerville, MA", updated=now, started=now)
+        phash = image_index.to_signed(0x0fedcba987654321)
+        pages = [proposal.images.create(url=f"http://example.com/page/{i}",
+                                        width=300, height=300,
+                                        phash=phash ^ i)
+                 for i in range(2)]
+
+        for i, page in enumerate(pages):
+            cache.delete_many([f"image:{page.pk}:checked",
+                               f"image:{page.pk}:vision"])
+            result = {"logo": None, "textual": True,
+                      "empty_streetview": False, "text": f"Page {i}"}
+            with mock.patch.object(tasks.vision, "process_images",
+                                   return_value=([result], [])) as process:
+                tasks.classify_images([page.pk])
+            process.assert_called_once()
+            self.assertEqual(cache.get(f"image:{page.pk}:text"), f"Page {i}")
+
+
+@tag("proposal", "images")
+class TestPdfImages(TestCase):
+    def get_images(self, streams, **kwargs):
+        writer = PdfFileWriter()
+        pdf_file = write_pdf(writer,
+                             [[writer._addObject(s) for s in streams]])
+        with pdf_file:
+            return list(pdf.get_images(pdf_file.name, **kwargs))
+
+    def test_early_filtering(self):
+        # Small images and long strips are skipped without being decoded:
+        with mock.patch.object(pdf.Image, "frombytes",
+                               wraps=pdf.Image.frombytes) as frombytes:
+            images = self.get_images([image_stream((255, 0, 0), 100, 100),
+                                      image_stream((0, 255, 0), 1600, 160),
+                                      image_stream((0, 0, 255), 300, 200)])
+        self.assertEqual([(w, h) for _, _, w, h in images], [(300, 200)])
+        self.assertEqual(frombytes.call_count, 1)
+
+    def test_jpeg_passthrough(self):
+        stream = image_stream((0, 0, 255), jpeg=True)
+        [(data, ext, _, _)] = self.get_images([stream])
+        self.assertEqual(ext, "jpg")
+        self.assertEqual(data.read(), stream._data)
+
+
+@tag("proposal", "query")
+class TestQuery(TestCase):
+    def test_canonical_query(self):
+        _, digest_a = canonical_query(QueryDict(
+            "box=42.3801,-71.1002,42.3902,-71.0801&region=Somerville, MA"))
+        _, digest_b = canonical_query(QueryDict(
+            "region=Somerville, MA&box=42.3803,-71.1004,42.3905,-71.0803"
+            "&format=json"))
+        self.assertEqual(digest_a, digest_b)
+
+        params, _ = canonical_query(
+            QueryDict("box=42.3801,-71.1002,42.3902,-71.0801"))
+        lat_min, lng_min, lat_max, lng_max = \
+            map(float, params["box"].split(","))
+        self.assertLessEqual(lat_min, 42.3801)
+        self.assertLessEqual(lng_min, -71.1002)
+        self.assertGreaterEqual(lat_max, 42.3902)
+        self.assertGreaterEqual(lng_max, -71.0801)
+
+    def test_multi_query(self):
+        now = datetime.now(pytz.utc)
+        for i, (lng, lat) in enumerate([(-71.08, 42.37), (-71.10, 42.39),
+                                         (-71.12, 42.41)]):
+            Proposal.objects.create(
+                case_number=f"ZBA 2017-{i}", case_numbers=[f"ZBA 2017-{i}"],
+                address=f"{i} Cherry Street", location=Point(lng, lat),
+                updated=now, started=now)
+        query = build_multi_query([{"box": "42.36,-71.09,42.38,-71.07"},
+                                   {"box": "42.38,-71.11,42.40,-71.09"}])
+        self.assertEqual(
+            set(Proposal.objects.filter(query)
+                .values_list("case_number", flat=True)),
+            {"ZBA 2017-0", "ZBA 2017-1"})
+
+    def test_attributes_query(self):
+        now = datetime.now(pytz.utc)
+        attributes = [{"applicant_name": "Sally Bobson",
+                       "zoning": "Residential"},
+                      {"applicant_name": "Sally Bobson",
+                       "zoning": "Commercial"},
+                      {"applicant_name": "Joe Jobson",
+                       "zoning": "Residential"}]
+        for i, attrs in enumerate(attributes):
+            proposal = Proposal.objects.create(
+                case_number=f"ZBA 2017-{i}", case_numbers=[f"ZBA 2017-{i}"],
+                address=f"{i} Cherry Street", location=Point(-71.08, 42.37),
+                updated=now, started=now)
+            for handle, value in attrs.items():
+                proposal.attributes.create(name=handle, handle=handle,
+                                           text_value=value, published=now)
+
+        def matching(params):
+            return set(Proposal.objects
+                       .filter(pk__in=run_attributes_query(params))
+                       .values_list("case_number", flat=True))
+
+        self.assertEqual(matching({"attr.applicant_name": "Sally",
+                                   "attr.zoning": "residential"}),
+                         {"ZBA 2017-0"})
+        self.assertEqual(matching({"attr.*": "residential"}),
+                         {"ZBA 2017-0", "ZBA 2017-2"})
+        self.assertEqual(matching({"attr.*": "commercial",
+                                   "attr.applicant_name": "Sally"}),
+                         {"ZBA 2017-1"})
+        self.assertEqual(matching({"attr.applicant_name": "Joe",
+                                   "attr.zoning": "commercial"}),
+                         set())
+
+
+@tag("proposal", "tiles")
+class TestTiles(TestCase):
+    def test_tile_for(self):
+        for z in (0, 5, 12, 18):
+            x, y = tiles.tile_for(-71.08, 42.37, z)
+            lng_min, lat_min, lng_max, lat_max = tiles.tile_bounds(z, x, y)
+            self.assertTrue(lng_min <= -71.08 < lng_max)
+            self.assertTrue(lat_min <= 42.37 < lat_max)
+
+    def test_version_key(self):
+        z = settings.TILE_MAX_ZOOM
+        x, y = tiles.tile_for(-71.08, 42.37, z)
+        self.assertEqual(tiles.version_key(z + 2, x * 4 + 3, y * 4 + 1),
+                         tiles.version_key(z, x, y))
+
+
+@tag("proposal", "views")
+class TestSerialization(TestCase):
+    def setUp(self):
+        now = datetime.now(pytz.utc)
+        for i in range(3):
+            proposal = Proposal.objects.create(
+                case_number=f"ZBA 2017-{i}", case_numbers=[f"ZBA 2017-{i}"],
+                address=f"{i} Cherry Street", location=Point(-71.08, 42.37),
+                updated=now, started=now)
+            proposal.attributes.create(name="Applicant Name",
+                                       handle="applicant_name",
+                                       text_value="Sally Bobson",
+                                       published=now)
+            for priority in range(2):
+                proposal.images.create(url=f"http://example.com/{i}/{priority}",
+                                       width=300, height=300,
+                                       priority=priority)
+
+    def test_proposals_json(self):
+        proposals = Proposal.objects.order_by("pk")
+        expected = [proposal_json(p, include_images=1, include_events=True)
+                    for p in proposals]
+        with self.assertNumQueries(5):
+            serialized = proposals_json(proposals, include_images=1,
+                                        include_events=True)
+        self.assertEqual(serialized, expected)
+
+    def test_cursor_page(self):
+        first, cursor = cursor_page(Proposal.objects.all(), "updated", "", 2)
+        self.assertEqual(len(first), 2)
+        rest, next_cursor = cursor_page(Proposal.objects.all(), "updated",
+                                        cursor, 2)
+        self.assertIsNone(next_cursor)
+        self.assertEqual(
+            [p.pk for p in first + rest],
+            list(Proposal.objects.order_by("-updated", "-pk")
+                 .values_list("pk", flat=True)))
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, chunks=(), headers=None, fail=False):
+        """
+        :param fail: if True, the connection is dropped after the chunks have
+        been sent
+        """
+        self.status_code = status_code
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.reason = ""
+        self.fail = fail
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+        if self.fail:
+            raise requests.exceptions.ChunkedEncodingError()
+
+
+def create_document(proposal, url):
+    # Keep the new document from being sent for processing:
+    with mock.patch.object(tasks.process_document, "delay"):
+        return proposal.documents.create(url=url, title="Staff Report",
+                                         field="reports")
+
+
+@tag("proposal", "documents")
+class TestDownload(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.path = os.path.join(media_root.name, "doc.pdf.part")
+        cache.delete("test:partial")
+
+    def download(self, *responses, headers={}):
+        with mock.patch.object(documents.SESSION, "get",
+                               side_effect=responses) as get:
+            result = documents.download("http://example.com/doc.pdf",
+                                        self.path, headers, "test:partial")
+        with open(self.path, "rb") as infile:
+            contents = infile.read()
+        return result, contents, [c[1]["headers"] for c in get.call_args_list]
+
+    def test_resume(self):
+        (_, hasher), contents, sent = self.download(
+            FakeResponse(200, [b"abc"], {"ETag": '"v1"'}, fail=True),
+            FakeResponse(206, [b"def"]))
+        self.assertEqual(sent[1]["Range"], "bytes=3-")
+        self.assertEqual(sent[1]["If-Range"], '"v1"')
+        self.assertEqual(contents, b"abcdef")
+        self.assertEqual(hasher.hexdigest(),
+                         hashlib.sha256(b"abcdef").hexdigest())
+
+    def test_range_ignored(self):
+        (_, hasher), contents, sent = self.download(
+            FakeResponse(200, [b"abc"], {"ETag": '"v1"'}, fail=True),
+            FakeResponse(200, [b"abcdef"], {"ETag": '"v1"'}))
+        self.assertEqual(sent[1]["Range"], "bytes=3-")
+        self.assertEqual(contents, b"abcdef")
+        self.assertEqual(hasher.hexdigest(),
+                         hashlib.sha256(b"abcdef").hexdigest())
+
+    def test_not_modified(self):
+        now = datetime.now(pytz.utc)
+        proposal = Proposal.objects.create(
+            case_number="ZBA 2017-1", case_numbers=["ZBA 2017-1"],
+            address="1 Cherry Street", location=Point(-71.08, 42.37),
+            updated=now, started=now)
+        doc = create_document(proposal, "http://example.com/doc.pdf")
+        doc.document = default_storage.save(f"doc/{doc.pk}/download.pdf",
+                                            ContentFile(b"abc"))
+        doc.etag = '"v1"'
+        doc.save()
+
+        with mock.patch.object(documents.SESSION, "get",
+                               return_value=FakeResponse(304)) as get:
+            result = documents.save_from_url(doc, doc.url, "download")
+        self.assertEqual(get.call_args[1]["headers"]["If-None-Match"],
+                         '"v1"')
+        self.assertEqual(result, (True, 304, False))
+        self.assertEqual(default_storage.open(doc.document.name).read(),
+                         b"abc")
+
+    def test_copy_processed(self):
+        now = datetime.now(pytz.utc)
+        docs = []
+        for i in range(2):
+            proposal = Proposal.objects.create(
+                case_number=f"ZBA 2017-{i}", case_numbers=[f"ZBA 2017-{i}"],
+                address=f"{i} Cherry Street", location=Point(-71.08, 42.37),
+                updated=now, started=now)
+            doc = create_document(proposal, f"http://example.com/{i}.pdf")
+            response = FakeResponse(200, [b"abc"], {"ETag": f'"{i}"'})
+            with mock.patch.object(documents.SESSION, "get",
+                                   return_value=response):
+                documents.save_from_url(doc, doc.url, "download")
+            docs.append(doc)
+
+        source, doc = docs
+        self.assertEqual(doc.document.name, source.document.name)
+        source.fulltext = "doc/text.txt"
+        source.completed_stages = list(tasks.COPIED_STAGES)
+        source.save(update_fields=["fulltext", "completed_stages"])
+        source.images.create(proposal=source.proposal, image="doc/image.jpg",
+                             width=300, height=300)
+
+        self.assertEqual(documents.find_processed_copy(doc,
+                                                       tasks.COPIED_STAGES),
+                         source)
+        generation = query_generation()
+        images = documents.copy_processed(doc, source)
+        self.assertEqual([image.image.name for image in images],
+                         ["doc/image.jpg"])
+        self.assertEqual(doc.images.count(), 1)
+        self.assertEqual(doc.fulltext.name, "doc/text.txt")
+        self.assertGreater(query_generation(), generation)
+
+
 @tag("tasks")
 class TestTasks(TestCase):
     @classmethod
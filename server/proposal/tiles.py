@@ -0,0 +1,79 @@
+"""Web Mercator tile arithmetic and per-tile versions.
+
+Each tile at zoom levels up to TILE_MAX_ZOOM has a version number in Redis,
+which is incremented whenever a proposal inside the tile is saved or
+deleted. Cached tiles include the version in their keys, so a change to one
+proposal only invalidates the tiles that contain it. Tiles beyond
+TILE_MAX_ZOOM share the version of their ancestor at TILE_MAX_ZOOM.
+"""
+import math
+
+from django.conf import settings
+
+from redis_utils import Redis
+
+
+def tile_bounds(z, x, y):
+    """:returns: the (lng_min, lat_min, lng_max, lat_max) bounds of a tile"""
+    n = 2 ** z
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def tile_box(z, x, y):
+    """:returns: the bounds of a tile as a `box` query parameter"""
+    lng_min, lat_min, lng_max, lat_max = tile_bounds(z, x, y)
+    return f"{lat_min},{lng_min},{lat_max},{lng_max}"
+
+
+def tile_for(lng, lat, z):
+    """:returns: the (x, y) coordinates of the tile containing a point"""
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return (min(x, n - 1), min(y, n - 1))
+
+
+def is_valid(z, x, y):
+    return 0 <= z <= 30 and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def version_key(z, x, y):
+    max_zoom = settings.TILE_MAX_ZOOM
+    if z > max_zoom:
+        shift = z - max_zoom
+        z, x, y = max_zoom, x >> shift, y >> shift
+    return f"tile:version:{z}:{x}:{y}"
+
+
+def tile_version(z, x, y):
+    return int(Redis.get(version_key(z, x, y)) or 0)
+
+
+def touched_tiles(points):
+    """:param points: an iterable of Points
+    :returns: the set of (z, x, y) tiles, at every versioned zoom level, that
+    contain at least one of the points
+    """
+    tiles = set()
+    for point in points:
+        for z in range(settings.TILE_MAX_ZOOM + 1):
+            tiles.add((z, *tile_for(point.x, point.y, z)))
+    return tiles
+
+
+def bump_tiles(points):
+    """Increment the versions of the tiles containing any of the given points.
+    """
+    tiles = touched_tiles(p for p in points if p)
+    if not tiles:
+        return
+
+    with Redis.pipeline() as pipe:
+        for tile in tiles:
+            pipe.incr(version_key(*tile))
+        pipe.execute()
@@ -13,6 +13,8 @@ urlpatterns = [
     path("view/<int:pk>", views.view_proposal, name="view-proposal"),
     path("events", views.list_events, name="list-events"),
     path("event/<int:pk>", views.view_event, name="event"),
+    path("tile/<int:z>/<int:x>/<int:y>", views.proposal_tile,
+         name="proposal-tile"),
     path("layers", views.list_layers),
     path("image/<int:pk>", views.view_image),
     path("image", views.view_image),
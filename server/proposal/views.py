@@ -1,21 +1,30 @@
+import base64
+import binascii
 from celery import shared_task
-from functools import reduce
 import json
-from operator import or_
+import time
 from urllib import parse
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.db.models import Q
+from django.db import connection
+from django.db.models import (Avg, Count, FloatField, Func, Min, OuterRef,
+                              Prefetch, Q, Subquery, prefetch_related_objects)
 from django.forms.models import model_to_dict
 from django.http import FileResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils import dateparse
 
 from shared.request import make_response, ErrorResponse
 
-from .models import Proposal, Attribute, Document, Event, Image, Layer
-from .query import build_proposal_query, build_event_query
+from .models import (Proposal, Attribute, Document, Event, Image, Layer,
+                     query_generation)
+from .query import (build_proposal_query, build_event_query,
+                    build_multi_query, canonical_query, document_headlines,
+                    rank_by_text)
+from . import tiles
 from utils import bounds_from_box, add_params
 
 default_attributes = [
@@ -29,6 +38,9 @@ def proposal_json(proposal,
                   include_events=False,
                   include_documents=True,
                   include_projects=True):
+    """Serialize a proposal. Uses the related objects loaded by
+    prefetch_proposals when they are available.
+    """
     pdict = model_to_dict(proposal, exclude=["location", "fulltext"])
     pdict["location"] = {
         "lat": proposal.location.y,
@@ -39,17 +51,23 @@ def proposal_json(proposal,
         pdict["documents"] = [d.to_dict() for d in proposal.documents.all()]
 
     if include_images:
-        images = proposal.images.order_by("-priority")
-        # Booleans are considered integers
-        if isinstance(include_images, int) and include_images is not True:
-            images = images[0:include_images]
+        if hasattr(proposal, "top_images"):
+            images = proposal.top_images
+        else:
+            images = proposal.images.order_by("-priority")
+            # Booleans are considered integers
+            if isinstance(include_images, int) and include_images is not True:
+                images = images[0:include_images]
 
         pdict["images"] = [img.to_dict() for img in images]
 
     if include_attributes:
-        attributes = proposal.attributes.filter(hidden=False)
-        if include_attributes is not True:
-            attributes = attributes.filter(handle__in=include_attributes)
+        if hasattr(proposal, "visible_attributes"):
+            attributes = proposal.visible_attributes
+        else:
+            attributes = proposal.attributes.filter(hidden=False)
+            if include_attributes is not True:
+                attributes = attributes.filter(handle__in=include_attributes)
         pdict["attributes"] = [a.to_dict() for a in attributes]
 
     if include_events:
@@ -60,11 +78,62 @@ def proposal_json(proposal,
 
     # TODO: Filter on parcel attributes
 
-    # TODO: fulltext query
-
     return pdict
 
 
+def prefetch_proposals(proposals,
+                       include_images=True,
+                       include_attributes=default_attributes,
+                       include_events=False,
+                       include_documents=True,
+                       include_projects=True):
+    """Load the related objects that proposal_json needs for all of `proposals`
+    with one query per relation, rather than several queries per proposal.
+
+    :param proposals: a sequence of Proposals, such as a queryset or a page
+
+    :returns: a list of the proposals
+    """
+    proposals = list(proposals)
+    lookups = []
+
+    if include_documents:
+        lookups.append("documents")
+
+    if include_images:
+        images = Image.objects.order_by("-priority")
+        # Booleans are considered integers
+        if isinstance(include_images, int) and include_images is not True:
+            top_ids = Image.objects.filter(proposal=OuterRef("proposal"))\
+                                   .order_by("-priority")\
+                                   .values("pk")[:include_images]
+            images = images.filter(pk__in=Subquery(top_ids))
+        lookups.append(Prefetch("images", queryset=images,
+                                to_attr="top_images"))
+
+    if include_attributes:
+        attributes = Attribute.objects.filter(hidden=False)
+        if include_attributes is not True:
+            attributes = attributes.filter(handle__in=include_attributes)
+        lookups.append(Prefetch("attributes", queryset=attributes,
+                                to_attr="visible_attributes"))
+
+    if include_events:
+        lookups.append("events")
+
+    if include_projects:
+        lookups.append("project__budgetitem_set")
+
+    prefetch_related_objects(proposals, *lookups)
+    return proposals
+
+
+def proposals_json(proposals, **kwargs):
+    "Serialize several proposals with a fixed number of queries."
+    return [proposal_json(proposal, **kwargs)
+            for proposal in prefetch_proposals(proposals, **kwargs)]
+
+
 def layer_json(layer):
     return {"name": layer.name,
             "icon_text": layer.icon_text,
@@ -73,16 +142,19 @@ def layer_json(layer):
             "region_name": layer.region_name}
 
 
-def _query(req):
-    queries = req.GET.getlist("query")
+def query_filter(params):
+    queries = params.getlist("query")
     if queries:
-        query = reduce(or_, (build_proposal_query(json.loads(q))
-                             for q in queries), Q())
-    else:
-        query = build_proposal_query(req.GET)
-    proposals = Proposal.objects.filter(query)
-    if "include_projects" in req.GET:
+        return build_multi_query([json.loads(q) for q in queries])
+    return build_proposal_query(params)
+
+
+def _query(params):
+    proposals = Proposal.objects.filter(query_filter(params))
+    if "include_projects" in params:
         proposals = proposals.select_related("project")
+    if params.get("q"):
+        proposals = rank_by_text(proposals, params["q"])
     return proposals
 
 
@@ -101,27 +173,142 @@ def paginator_context(page, page_url=lambda page: f"?page={page}"):
     }
 
 
+# Fields that proposals can be ordered by when paging with a cursor. Ties are
+# broken by id.
+CURSOR_ORDERS = ("updated", "started")
+
+
+def encode_cursor(order, proposal):
+    data = [order, getattr(proposal, order).isoformat(), proposal.pk]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """:returns: a tuple of the order field, the value of that field, and the id
+    of the last proposal on the previous page
+
+    :raises: ValueError if the cursor is malformed
+    """
+    try:
+        order, value, pk = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+        value = dateparse.parse_datetime(value)
+        pk = int(pk)
+    except (binascii.Error, TypeError, UnicodeDecodeError) as err:
+        raise ValueError(cursor) from err
+    if order not in CURSOR_ORDERS or not value:
+        raise ValueError(cursor)
+    return order, value, pk
+
+
+def cursor_page(proposals, order, cursor, per_page):
+    """Fetch a page of proposals, newest first, that come after the proposal
+    identified by `cursor`. Rather than counting and skipping the proposals on
+    earlier pages, this filters on the (order, id) of the last one.
+
+    :returns: a tuple of the proposals and the cursor for the next page (or
+    None, if there are no more)
+    """
+    if cursor:
+        order, value, pk = decode_cursor(cursor)
+        proposals = proposals.filter(Q(**{f"{order}__lt": value}) |
+                                     Q(**{order: value, "pk__lt": pk}))
+
+    page = list(proposals.order_by(f"-{order}", "-pk")[:per_page+1])
+    next_cursor = encode_cursor(order, page[per_page-1]) \
+        if len(page) > per_page else None
+
+    return page[:per_page], next_cursor
+
+
+def estimated_count(queryset):
+    "Get the planner's estimate of the number of rows in a queryset."
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+def get_per_page(params, default=50):
+    try:
+        per_page = int(params.get("per_page", default))
+    except ValueError:
+        per_page = default
+    return max(1, min(per_page, default))
+
+
+def proposals_etag(req):
+    _, digest = canonical_query(req.GET)
+    # Relative time ranges mean that results can change even if no proposals
+    # do, so tags also expire after QUERY_CACHE_TIMEOUT:
+    period = int(time.time() // settings.QUERY_CACHE_TIMEOUT)
+    return f"{query_generation()}-{period}-{digest}"
+
+
 # Views:
-@make_response("list.djhtml")
+@make_response("list.djhtml", etag=proposals_etag)
 def list_proposals(req):
-    proposals = _query(req)
+    """List proposals matching the query.
+
+    By default, results are paged by page number. To page with a cursor
+    instead, include a `cursor` parameter (empty for the first page) and
+    optionally `order` (one of CURSOR_ORDERS). Cursor pages include a
+    `next_cursor` and an estimated count instead of an exact one.
+
+    Responses are cached until a proposal or related object changes (see
+    QUERY_GENERATION_KEY). The box is snapped to a grid first, so that nearby
+    map views share responses.
+    """
+    params, digest = canonical_query(req.GET)
+    cache_key = f"query:proposals:{query_generation()}:{digest}"
+    context = cache.get(cache_key)
+    if context is None:
+        context = _list_proposals(req, params)
+        cache.set(cache_key, context, settings.QUERY_CACHE_TIMEOUT)
+
+    return context
+
+
+def _list_proposals(req, params):
+    proposals = _query(params)
 
     try:
-        page = int(req.GET["page"])
+        page = int(params["page"])
     except (ValueError, KeyError):
         page = 1
 
     context = {}
 
-    if page:
+    if "cursor" in params:
+        per_page = get_per_page(params)
+        order = params.get("order", "updated")
+        if order not in CURSOR_ORDERS:
+            raise ErrorResponse("Invalid order", {"order": order})
+        count = estimated_count(proposals)
         try:
-            per_page = int(req.GET.get("per_page", 50))
-        except ValueError:
-            per_page = 50
-        paginator = Paginator(proposals, per_page=min(per_page, 50))
+            proposals, next_cursor = cursor_page(
+                proposals, order, params["cursor"], per_page)
+        except ValueError as err:
+            raise ErrorResponse("Invalid cursor", {"cursor": params["cursor"]},
+                                err=err)
+        query_params = params.copy()
+        query_params["cursor"] = next_cursor
+        context["paginator"] = {
+            "estimated_count": count,
+            "next_cursor": next_cursor,
+            "next_url": next_cursor and (req.path + "?" +
+                                         query_params.urlencode()),
+            "per_page": per_page
+        }
+    elif page:
+        per_page = get_per_page(params)
+        paginator = Paginator(proposals, per_page=per_page)
         proposals = paginator.page(page)
         try:
-            query_params = req.GET.copy()
+            query_params = params.copy()
             def make_url(page):
                 query_params["page"] = page
                 return req.path + "?" + query_params.urlencode()
@@ -130,14 +317,118 @@ def list_proposals(req):
         except (PageNotAnInteger, EmptyPage) as err:
             raise ErrorResponse("No such page", {"page": page}, err=err)
 
+    proposals = prefetch_proposals(proposals, include_images=1,
+                                   include_events=True)
     context["proposals"] = [
         proposal_json(
             proposal, include_images=1, include_events=True) for proposal in proposals
     ]
 
+    if params.get("q"):
+        match_ids = [p.text_match_id for p in proposals if p.text_match_id]
+        snippets = document_headlines(
+            Document.objects.filter(pk__in=match_ids), params["q"])
+        for proposal, pdict in zip(proposals, context["proposals"]):
+            if proposal.text_match_id:
+                pdict["text_match"] = {
+                    "document": proposal.text_match_id,
+                    "rank": proposal.text_rank,
+                    "snippet": snippets.get(proposal.text_match_id)
+                }
+
     return context
 
 
+# Parameters replaced by the bounds of the tile:
+TILE_EXCLUDED_PARAMS = {"box", "center", "r", "page", "cursor", "order",
+                        "per_page", "include_projects"}
+
+
+def tile_query(req):
+    params, _ = canonical_query(req.GET)
+    for param in TILE_EXCLUDED_PARAMS:
+        params.pop(param, None)
+    return canonical_query(params)
+
+
+def tile_state(req, z, x, y):
+    """A string that changes whenever the contents of the tile might. Tiles
+    are versioned individually (see proposal.tiles), but queries that match
+    on attributes or document text also depend on the query generation.
+    """
+    params, digest = tile_query(req)
+    generation = query_generation() \
+        if any(k == "q" or k.startswith("attr.") for k in params) else ""
+    period = int(time.time() // settings.QUERY_CACHE_TIMEOUT)
+    return f"{tiles.tile_version(z, x, y)}-{generation}-{period}-{digest}"
+
+
+def point_feature(lng, lat, properties):
+    return {"type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lng, lat]},
+            "properties": properties}
+
+
+def cluster_tile(proposals, z, x, y):
+    """Group the proposals in a tile by cell, using a single query.
+
+    :returns: a list of GeoJSON Point features. Clusters are placed at the
+    mean location of their proposals and have a `count`; lone proposals have
+    an `id` instead.
+    """
+    lng_min, lat_min, lng_max, lat_max = tiles.tile_bounds(z, x, y)
+    proposals = proposals.filter(
+        location__within=bounds_from_box(tiles.tile_box(z, x, y)))\
+        .order_by()
+    lng = Func("location", function="ST_X", output_field=FloatField())
+    lat = Func("location", function="ST_Y", output_field=FloatField())
+
+    if z > settings.TILE_CLUSTER_MAX_ZOOM:
+        return [point_feature(p_lng, p_lat, {"id": pk}) for pk, p_lng, p_lat
+                in proposals.annotate(lng=lng, lat=lat)
+                .values_list("pk", "lng", "lat")]
+
+    cells = settings.TILE_CLUSTER_CELLS
+    width = (lng_max - lng_min) / cells
+    height = (lat_max - lat_min) / cells
+    rows = proposals.annotate(
+        cell_x=Func((lng - lng_min) / width, function="floor",
+                    output_field=FloatField()),
+        cell_y=Func((lat - lat_min) / height, function="floor",
+                    output_field=FloatField()))\
+        .values("cell_x", "cell_y")\
+        .annotate(count=Count("pk"), lng=Avg(lng), lat=Avg(lat),
+                  first_id=Min("pk"))
+
+    return [point_feature(row["lng"], row["lat"],
+                          {"id": row["first_id"]} if row["count"] == 1
+                          else {"count": row["count"]})
+            for row in rows]
+
+
+@make_response(etag=tile_state)
+def proposal_tile(req, z, x, y):
+    """Proposals matching the query in the z/x/y map tile, as a GeoJSON
+    FeatureCollection. Nearby proposals are clustered, except at the
+    highest zoom levels. Accepts the same parameters as list_proposals, but
+    the tile takes the place of `box` or `center`.
+
+    Tiles are cached until a proposal inside them changes.
+    """
+    if not tiles.is_valid(z, x, y):
+        raise ErrorResponse("Invalid tile", {"tile": [z, x, y]}, status=404)
+
+    cache_key = f"query:tile:{z}:{x}:{y}:{tile_state(req, z, x, y)}"
+    features = cache.get(cache_key)
+    if features is None:
+        params, _ = tile_query(req)
+        features = cluster_tile(Proposal.objects.filter(query_filter(params)),
+                                z, x, y)
+        cache.set(cache_key, features, settings.QUERY_CACHE_TIMEOUT)
+
+    return {"type": "FeatureCollection", "features": features}
+
+
 @make_response("view.djhtml")
 def view_proposal(req, pk=None):
     pk = req.GET.get("pk", pk)
@@ -208,14 +499,11 @@ def view_event(req, pk=None):
 
     event = get_object_or_404(Event, pk=pk)
     d = event.to_json_dict()
-    d["proposals"] = [
-        proposal_json(
-            p,
-            include_images=False,
-            include_attributes=["applicant_name", "legal_notice"],
-            include_documents=False)
-        for p in event.proposals.all().select_related("project")
-    ]
+    d["proposals"] = proposals_json(
+        event.proposals.all().select_related("project"),
+        include_images=False,
+        include_attributes=["applicant_name", "legal_notice"],
+        include_documents=False)
     return {"event": d}
 
 
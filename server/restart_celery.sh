@@ -13,7 +13,8 @@ fi
 if ! getent hosts celery; then
     export C_FORCE_ROOT=1
 
-    celery multi restart 2 -A $APP_NAME -l "${CELERY_LOGLEVEL:-info}" $celery_opts \
+    celery multi restart 2 -A $APP_NAME -l "${CELERY_LOGLEVEL:-info}" \
+           -Q "${CELERY_QUEUES:-celery,network,cpu,api}" $celery_opts \
            --pidfile=/var/run/celery/%n.pid \
            --logfile=/var/log/celery/%n%I.log
 fi
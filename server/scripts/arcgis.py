@@ -1,13 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
 import re
+import threading
+import time
 from urllib.parse import urlencode
 from urllib.request import urlopen
 
 import requests
 
+from .geocoding import NO_MATCH
 
-ADDRESS_URL = "http://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses"
-REVERSE_URL = "http://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/reverseGeocode"
+
+SERVICE_URL = "http://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer"
+ADDRESS_URL = SERVICE_URL + "/geocodeAddresses"
+REVERSE_URL = SERVICE_URL + "/reverseGeocode"
+TOKEN_URL = "https://www.arcgis.com/sharing/oauth2/token"
+
+# Used if the service does not report its maximum batch size:
+DEFAULT_BATCH_SIZE = 150
+
+# Error codes indicating that the access token is invalid or has expired:
+TOKEN_ERRORS = {498, 499}
 
 
 def camel_to_under(s):
@@ -21,6 +34,9 @@ def camel_to_under(s):
 def simplify(result):
     loc = result["location"]
     attrs = result["attributes"]
+    if attrs.get("Status") == "U":
+        # Unmatched
+        return NO_MATCH
     return {
         "location": {
             "lng": loc["x"],
@@ -39,54 +55,135 @@ def reverse_geocode(token, lat, lng):
     return response.json()
 
 
+def split_record(addr, city, region):
+    """Builds the attributes for a geocodeAddresses record from an address string
+    of the form '<street address>, <city>, <region>'. Missing components are
+    filled in from `city` and `region`.
+    """
+    parts = [p.strip() for p in addr.split(",")]
+    return {
+        "Address": parts[0],
+        "City": parts[1] if len(parts) > 1 and parts[1] else city,
+        "Region": parts[2] if len(parts) > 2 and parts[2] else region
+    }
+
+
 class ArcGISCoder(object):
-    def __init__(self, client_id, client_secret, url=ADDRESS_URL):
+    def __init__(self, client_id, client_secret, url=ADDRESS_URL,
+                 city="Somerville", region="MA", parallelism=4):
         assert client_id and client_secret, \
             "You must supply a client id and secret to ArcGISCoder"
 
         self.client_id = client_id
         self.client_secret = client_secret
         self.url = url
+        self.city = city
+        self.region = region
+        self.parallelism = parallelism
         self.access_token = None
-
-    def get_access_token(self):
-        if self.access_token:
+        self.token_expires = 0
+        self._max_batch_size = None
+        self._token_lock = threading.Lock()
+
+    def get_access_token(self, rejected=None):
+        """
+        :param rejected: a token that the service rejected. If it is still the
+        current token, fetch a new one; if another thread has already replaced
+        it, use the replacement.
+        """
+        with self._token_lock:
+            # Refresh the token a minute before it is due to expire:
+            if self.access_token and self.access_token != rejected and \
+               time.time() < self.token_expires - 60:
+                return self.access_token
+
+            data = urlencode([("grant_type", "client_credentials"),
+                              ("client_id", self.client_id),
+                              ("client_secret", self.client_secret)]).\
+                              encode("ISO-8859-1")
+            f = urlopen(TOKEN_URL, data)
+            json_response = json.loads(f.read().decode("utf-8"))
+
+            self.access_token = json_response["access_token"]
+            self.token_expires = time.time() + \
+                int(json_response.get("expires_in", 7200))
             return self.access_token
 
-        data = urlencode([("grant_type", "client_credentials"),
-                          ("client_id", self.client_id),
-                          ("client_secret", self.client_secret)]).\
-                          encode("ISO-8859-1")
-        f = urlopen("https://www.arcgis.com/sharing/oauth2/token",
-                    data)
-        json_response = json.loads(f.read().decode("utf-8"))
-
-        self.access_token = json_response["access_token"]
-        return self.access_token
-
-    def geocode(self, addrs, **kwargs):
-        if isinstance(addrs, str):
-            addrs = [addrs]
-
-        addresses = json.dumps(
-            {"records":
-             [{"attributes":
-               {
-                   "OBJECTID": i+1,
-                   "Address": addr,
-                   "City": "Somerville",
-                   "Region": "MA"
-               }} for i, addr in enumerate(addrs)]})
+    @property
+    def max_batch_size(self):
+        """The maximum number of records the service accepts in a single
+        geocodeAddresses request.
+        """
+        if not self._max_batch_size:
+            service_url = self.url.rsplit("/", 1)[0]
+            try:
+                info = requests.get(service_url,
+                                    {"f": "json",
+                                     "token": self.get_access_token()}).json()
+                self._max_batch_size = \
+                    info["locatorProperties"]["MaxBatchSize"]
+            except (KeyError, ValueError, requests.RequestException):
+                self._max_batch_size = DEFAULT_BATCH_SIZE
+        return self._max_batch_size
+
+    def _geocode_batch(self, records, rejected=None):
+        addresses = json.dumps({"records": [{"attributes": r}
+                                            for r in records]})
+        token = self.get_access_token(rejected)
         data = {
             "addresses": addresses,
-            "token": self.get_access_token(),
+            "token": token,
             "f": "json"
         }
 
         f = urlopen(self.url, urlencode(data).encode("ISO-8859-1"))
         result = json.loads(f.read().decode("utf-8"))
 
-        return [simplify(l) for l in result["locations"]]
+        if "error" in result:
+            if result["error"].get("code") in TOKEN_ERRORS and not rejected:
+                # The token was rejected, so fetch a new one and try again:
+                return self._geocode_batch(records, rejected=token)
+            raise Exception("Error from ArcGIS geocoder", result["error"])
+
+        return result["locations"]
+
+    def geocode(self, addrs, **kwargs):
+        """Geocode an iterable of address strings, splitting them into batches no
+        larger than the service allows and submitting the batches in parallel.
+        The city and region for each record are taken from the address string
+        when present, falling back on the `region` keyword argument and the
+        coder's defaults.
+        """
+        if isinstance(addrs, str):
+            addrs = [addrs]
+
+        region = kwargs.get("region")
+        default_city, default_region = self.city, self.region
+        if region:
+            region_parts = [p.strip() for p in region.split(",")]
+            default_city = region_parts[0] or default_city
+            if len(region_parts) > 1:
+                default_region = region_parts[1]
+
+        records = [dict(split_record(addr, default_city, default_region),
+                        OBJECTID=i+1)
+                   for i, addr in enumerate(addrs)]
+        if not records:
+            return []
+
+        size = self.max_batch_size
+        batches = [records[i:i+size] for i in range(0, len(records), size)]
+        if len(batches) > 1:
+            with ThreadPoolExecutor(min(self.parallelism, len(batches))) as pool:
+                locations = sum(pool.map(self._geocode_batch, batches), [])
+        else:
+            locations = self._geocode_batch(batches[0])
+
+        # The service does not guarantee that results are returned in the
+        # order they were submitted:
+        by_id = {l["attributes"]["ResultID"]: l for l in locations}
+        return [simplify(by_id[r["OBJECTID"]]) if r["OBJECTID"] in by_id
+                else None for r in records]
 
     def reverse_geocode(self, lat, lng):
         result = reverse_geocode(self.get_access_token(), lat, lng)
@@ -0,0 +1,18 @@
+"""Conventions shared by the geocoder classes.
+
+Each geocoder's `geocode` method takes an iterable of addresses and returns a
+list of results in the same order. A result is a dict with "location",
+"formatted_name" and "properties" keys, `NO_MATCH` if the service reported that
+it could not find the address, or None if the lookup failed.
+"""
+
+
+class _NoMatch(object):
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "NO_MATCH"
+
+
+NO_MATCH = _NoMatch()
@@ -1,6 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
-import threading
-from queue import Queue
+import time
 
 import logging
 
@@ -9,20 +9,42 @@ from urllib.request import urlopen
 
 import requests
 
+from .geocoding import NO_MATCH
+from .ratelimit import TokenBucket
+
 logger = logging.getLogger(__name__)
 
 URL = "https://maps.googleapis.com/maps/api/geocode/json"
 
-def geocode(api_key, address, bounds=None):
-    json_response = requests.get(
-        URL,
-        {"key": api_key,
-         "address": address,
-         "bounds": bounds or ""}
-    ).json()
+def geocode(api_key, address, bounds=None, limiter=None, retries=3,
+            backoff=1.0):
+    """Geocode a single address. If the API responds with OVER_QUERY_LIMIT,
+    retries up to `retries` times with exponential backoff.
+
+    :param limiter: optional TokenBucket used to stay under the QPS quota
+    :returns: the first result, NO_MATCH if the API found no results, or None
+    if the request failed
+    """
+    for attempt in range(retries + 1):
+        if limiter:
+            limiter.acquire()
+
+        json_response = requests.get(
+            URL,
+            {"key": api_key,
+             "address": address,
+             "bounds": bounds or ""}
+        ).json()
+
+        if json_response["status"] == "OVER_QUERY_LIMIT" and attempt < retries:
+            time.sleep(backoff * 2**attempt)
+            continue
+        break
 
     if json_response["status"] == "OK":
         return json_response["results"][0]
+    elif json_response["status"] == "ZERO_RESULTS":
+        return NO_MATCH
     else:
         logger.error("Error encountered while geocoding address: " +
                      "{address}\n{error}"
@@ -33,6 +55,8 @@ def simplify(result):
     """Takes a dictionary as returned from the Google Maps geocoder API and
 returns a flattened dict conforming to the generic geocoder expectations.
     """
+    if result is NO_MATCH:
+        return result
     if result:
         return {
             "location": result["geometry"]["location"],
@@ -59,35 +83,17 @@ def reverse_geocode(api_key, lat, lng):
         return data[0]["address_components"]
 
 
-class GeocoderThread(threading.Thread):
-    def __init__(self, addr_q, out, geocoder):
-        self.addr_q = addr_q
-        self.out = out
-        self.geocoder = geocoder
-        super().__init__()
-
-    def start(self):
-        while True:
-            address = self.addr_q.get_nowait()
-
-            if not address:
-                break
-
-            try:
-                print("Geocoding address:", address)
-                result = geocode(self.geocoder.api_key, address)
-                # Could return None
-                self.out.append((address, result and simplify(result)))
-            except Exception as err:
-                print("Error in thread", self, err)
-            finally:
-                self.addr_q.task_done()
-
-
 class GoogleGeocoder(object):
-    def __init__(self, api_key):
+    def __init__(self, api_key, parallelism=5, qps=50):
+        """
+        :param parallelism: the number of concurrent requests to make when
+        geocoding multiple addresses
+        :param qps: maximum requests per second, matching the API quota
+        """
         self.api_key = api_key
         self._bounds = None
+        self.parallelism = parallelism
+        self.limiter = TokenBucket(qps)
 
     @property
     def bounds(self):
@@ -99,35 +105,29 @@ class GoogleGeocoder(object):
         self._bounds = "{bounds[0]},{bounds[3]}|{bounds[2]},{bounds[1]}"\
             .format(bounds=bounds)
 
-    def geocode_threaded(self, addrs, parallelism=5):
-        address_q = Queue(len(addrs))
-        for addr in addrs:
-            address_q.put_nowait(addr)
-
-        # Use a list to collect results, because .append() is
-        # thread-safe
-        out = []
-
-        for i in range(parallelism):
-            gt = GeocoderThread(address_q, out, self)
-            gt.start()
-
-        address_q.join()
-
-        # Out is a list of pairs of (addr, result)
-        results = dict(out)
-
-        # Pluck out the results in the same order as the input
-        # addresses:
-        return [results[a] for a in addrs]
+    def _geocode_one(self, addr, bounds=None):
+        try:
+            return simplify(geocode(self.api_key, addr, bounds or self.bounds,
+                                    limiter=self.limiter))
+        except (requests.RequestException, ValueError, KeyError):
+            logger.exception("Error encountered while geocoding address: %s",
+                             addr)
+            return None
+
+    def geocode_threaded(self, addrs, parallelism=None, bounds=None):
+        """Geocode addresses concurrently using a pool of `parallelism` threads.
+        Results are returned in the same order as the input addresses, with None
+        in place of any address whose lookup failed.
+        """
+        with ThreadPoolExecutor(parallelism or self.parallelism) as pool:
+            return list(pool.map(lambda a: self._geocode_one(a, bounds), addrs))
 
     def geocode(self, addrs, bounds=None, region=None):
-        results = []
-        for addr in addrs:
-            if region:
-                addr += " " + region
-            results.append(simplify(geocode(self.api_key, addr, self.bounds)))
-        return results
+        if region:
+            addrs = [addr + " " + region for addr in addrs]
+        if self.parallelism > 1:
+            return self.geocode_threaded(addrs, bounds=bounds)
+        return [self._geocode_one(addr, bounds) for addr in addrs]
 
     def reverse_geocode(self, lat, lng):
         results = _reverse_geocode(self.api_key, lat, lng)
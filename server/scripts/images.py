@@ -1,40 +1,29 @@
 from collections import namedtuple
 from io import BytesIO
 import os
-import subprocess
 
 from PIL import Image
 
 ImageInfo = namedtuple("ImageInfo", "name type width height depth space size")
 
+MODE_DEPTHS = {"1": 1, "I;16": 16, "I": 32, "F": 32}
+
 
 def image_info(image_path):
-    """Get information about the image at the given path. Requires the
-'identify' command line utility.
+    """Get information about the image at the given path. Only the header of the
+    image is read.
 
     """
-    p = subprocess.Popen(["identify", image_path],
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-
-    status = p.wait()
-
-    if status:
-        raise Exception("Error in command: {error}"
-                        .format(error=p.stderr.read()))
-
-    output = p.stdout.read().decode("utf-8")
-    name, imgtype, dim, _, bit_depth, cspace, size, _ = output.split(" ", 7)
-
-    w, h = dim.split("x")
-
-    return ImageInfo(name, imgtype, int(w), int(h), bit_depth,
-                     cspace, size)
+    with Image.open(image_path) as image:
+        return ImageInfo(os.path.basename(image_path), image.format,
+                         image.width, image.height,
+                         MODE_DEPTHS.get(image.mode, 8), image.mode,
+                         os.path.getsize(image_path))
 
 
 def dimensions(image_path):
-    info = image_info(image_path)
-    return info.width, info.height
+    with Image.open(image_path) as image:
+        return image.size
 
 
 def is_interesting(image_path):
@@ -57,12 +46,42 @@ def pad(image, width, height, fill="black"):
     """
     w, h = image.size
     new_image = Image.new(image.mode, (width, height), fill)
-    new_image.paste(image, ((w-width)/2, (h-height)/2))
+    new_image.paste(image, ((width-w)//2, (height-h)//2))
     return new_image
 
 
-def thumbnail_name(image_path):
-    return "thumb_" + os.path.basename(image_path)
+pad_image = pad
+
+
+def scaled_size(size, percent):
+    w, h = size
+    return (max(1, round(w*percent)), max(1, round(h*percent)))
+
+
+def make_thumbnails(image, sizes):
+    """Resizes an image to fit within each of several bounds. The image is only
+    decoded once, and JPEGs are decoded at a reduced scale when possible.
+
+    :param image: PIL Image or path
+    :param sizes: dict mapping names to (width, height) bounds
+
+    :returns: dict mapping the names to PIL Images
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.open(image, "r")
+    w, h = image.size
+
+    percents = {name: min(1, fit_w/w, fit_h/h)
+                for name, (fit_w, fit_h) in sizes.items()}
+    # Decode no more than is needed for the largest size:
+    image.draft(image.mode, scaled_size((w, h), max(percents.values())))
+
+    thumbs = {}
+    for name, percent in percents.items():
+        size = scaled_size((w, h), percent)
+        thumbs[name] = image if size == image.size else \
+            image.resize(size, Image.LANCZOS)
+    return thumbs
 
 
 def make_thumbnail(image, percent=None, fit=None, dim=None, dest_file=None,
@@ -77,22 +96,46 @@ def make_thumbnail(image, percent=None, fit=None, dim=None, dest_file=None,
     w, h = image.size
 
     if not percent:
-        if fit:
-            fit_w, fit_h = fit
-            percent = min(fit_w/w, fit_h/h)
+        fit_w, fit_h = fit
+        percent = min(fit_w/w, fit_h/h)
+
+    if percent < 1:
+        size = scaled_size((w, h), percent)
+        image.draft(image.mode, size)
+        image = image.resize(size, Image.LANCZOS)
+
+    if pad and fit:
+        image = pad_image(image, fit[0], fit[1], pad_fill or "black")
+
+    if dest_file:
+        image.save(dest_file)
+
+    return image
+
+
+def jpeg_compatible(image):
+    return image if image.mode in ("RGB", "L") else image.convert("RGB")
+
+
+def write_thumbnails(image_path, sizes, paths):
+    """Generate thumbnails of the image at several sizes (see make_thumbnails)
+    and save them as JPEGs. Suitable for running in a separate process.
+
+    :param paths: dict mapping the names of the sizes to output paths
+
+    :returns: `paths`
+    """
+    for name, thumb in make_thumbnails(image_path, sizes).items():
+        os.makedirs(os.path.dirname(paths[name]), exist_ok=True)
+        jpeg_compatible(thumb).save(paths[name], "jpeg")
 
-    if percent >= 1:
-        # The original is smaller than the desired dimensions.
-        resized = image
-    else:
-        resized = image.resize(
-            (int(w*percent), int(h*percent)),
-            Image.LANCZOS)
-    return pad(image, fit_w, fit_h, pad_fill or "black") if pad else image
+    return paths
 
 
 def image_data(image, ext="jpeg"):
     image_out = BytesIO()
+    if ext == "jpeg":
+        image = jpeg_compatible(image)
     image.save(image_out, ext)
     image_out.seek(0)
     return image_out
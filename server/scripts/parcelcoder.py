@@ -0,0 +1,117 @@
+"""Offline geocoder that resolves street addresses to the centroids of matching
+parcels, using the address data imported from the assessor's database. Lookups
+that cannot be resolved locally are sent to a fallback geocoder.
+"""
+import threading
+import time
+
+from shared.address import normalize_number, normalize_street, split_address
+
+from .geocoding import NO_MATCH
+
+# MassGIS town ids for supported regions:
+REGION_TOWN_IDS = {
+    "somerville, ma": 274,
+    "cambridge, ma": 49,
+}
+
+
+def split_region(addr, region=None):
+    """Splits an address string of the form '<street address>, <region>'.
+    """
+    address, _, addr_region = addr.partition(",")
+    return address.strip(), (addr_region.strip() or region or "")
+
+
+def address_key(address):
+    split = split_address(address)
+    if split:
+        number, street = split
+        return (normalize_number(number), normalize_street(street))
+
+
+class ParcelGeocoder(object):
+    def __init__(self, fallback=None, index_ttl=60*60*24):
+        """
+        :param fallback: geocoder used when an address does not match a parcel
+        :param index_ttl: rebuild the in-memory parcel index after this many
+        seconds
+        """
+        self.fallback = fallback
+        self.index_ttl = index_ttl
+        self._index = None
+        self._index_built = 0
+        self._lock = threading.Lock()
+
+    def build_index(self):
+        """Builds a dict mapping (town_id, number, street) to the parcel with that
+        address. Addresses shared by several parcels (e.g., condominiums)
+        resolve to the first parcel found.
+        """
+        from django.contrib.gis.db.models.functions import Centroid
+        from parcel.models import Parcel
+
+        parcels = Parcel.objects.exclude(poly_type="ROW")\
+                                .filter(address_num__isnull=False,
+                                        full_street__isnull=False)\
+                                .annotate(centroid=Centroid("shape"))\
+                                .values_list("gid", "town_id", "address_num",
+                                             "full_street", "centroid")\
+                                .order_by("gid")
+        index = {}
+        for gid, town_id, num, street, centroid in parcels:
+            key = (town_id, normalize_number(num), normalize_street(street))
+            if key[1] and centroid and key not in index:
+                index[key] = (gid, centroid.x, centroid.y, f"{num} {street}")
+        return index
+
+    @property
+    def index(self):
+        with self._lock:
+            if self._index is None or \
+               time.time() - self._index_built > self.index_ttl:
+                self._index = self.build_index()
+                self._index_built = time.time()
+            return self._index
+
+    def lookup(self, addr, region=None):
+        address, region = split_region(addr, region)
+        key = address_key(address)
+        if not key:
+            return None
+
+        town_id = REGION_TOWN_IDS.get(region.lower())
+        match = self.index.get((town_id,) + key)
+        if not match:
+            return None
+
+        gid, lng, lat, formatted = match
+        return {
+            "location": {"lat": lat, "lng": lng},
+            "formatted_name": f"{formatted}, {region}" if region else formatted,
+            "properties": {
+                "types": ["parcel"],
+                "score": 100,
+                "parcel_id": gid
+            }
+        }
+
+    def geocode(self, addrs, **kwargs):
+        if isinstance(addrs, str):
+            addrs = [addrs]
+        addrs = list(addrs)
+        region = kwargs.get("region")
+        results = [self.lookup(addr, region) for addr in addrs]
+
+        misses = [i for i, result in enumerate(results) if not result]
+        if misses and self.fallback:
+            found = self.fallback.geocode([addrs[i] for i in misses], **kwargs)
+        else:
+            found = [NO_MATCH] * len(misses)
+        for i, result in zip(misses, found):
+            results[i] = result
+
+        return results
+
+    def reverse_geocode(self, lat, lng):
+        return self.fallback and self.fallback.reverse_geocode(lat, lng)
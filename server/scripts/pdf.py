@@ -1,16 +1,38 @@
 from PyPDF2 import PdfFileReader
 from PIL import Image
 from io import BytesIO
+import hashlib
 
 
-def xobjects(pdf):
+# Upper bound on the decoded size of the images extracted from one document:
+MAX_DECODED_BYTES = 256 * 2**20
+# Larger images are skipped without being decoded:
+MAX_IMAGE_PIXELS = 40 * 10**6
+
+COLOR_MODES = {"/DeviceRGB": ("RGB", 3),
+               "/DeviceGray": ("L", 1),
+               "/DeviceCMYK": ("CMYK", 4)}
+ICC_MODES = {1: ("L", 1), 3: ("RGB", 3), 4: ("CMYK", 4)}
+
+
+def xobjects(pdf, seen_keys=None):
+    """Generates the image XObjects of each page, along with a key that is the
+    same for every appearance of the same object. Pages are loaded as they are
+    needed. Note that PyPDF2 reads an object's raw (encoded) stream when it
+    resolves the object, so objects whose keys are in `seen_keys` are skipped
+    without being resolved.
+    """
     for page in pdf.pages:
         try:
             xobject = page["/Resources"]["/XObject"].getObject()
         except KeyError:
             continue
         for x_id in xobject:
-            yield x_id, xobject[x_id]
+            ref = xobject.raw_get(x_id)
+            key = (ref.idnum, ref.generation) if hasattr(ref, "idnum") else None
+            if key and seen_keys is not None and key in seen_keys:
+                continue
+            yield key, xobject[x_id]
 
 
 def default_name(i, ext, img):
@@ -18,47 +40,113 @@ def default_name(i, ext, img):
 
 
 def default_guard(xobject):
+    """Checks the dimensions recorded in the image dictionary, so that small
+    images, long strips, and very large images are skipped before their
+    contents are decoded.
+    """
     w = xobject["/Width"]
     h = xobject["/Height"]
 
-    return w >= 150 and h >= 150
+    return w >= 150 and h >= 150 and max(w, h) <= 8 * min(w, h) and \
+        w * h <= MAX_IMAGE_PIXELS
+
+
+def get(obj, key, default=None):
+    "Like dict.get, but resolves indirect objects."
+    return obj[key] if key in obj else default
+
+
+def image_filter(xobject):
+    filter = get(xobject, "/Filter")
+    if isinstance(filter, list):
+        return filter[0] if len(filter) == 1 else None
+    return filter
+
+
+def color_mode(xobject):
+    """:returns: a tuple of the PIL mode and the number of components for the
+    image's color space, or None if it is not supported
+    """
+    if get(xobject, "/BitsPerComponent", 8) != 8:
+        return None
+
+    space = get(xobject, "/ColorSpace")
+    if isinstance(space, list) and space and space[0] == "/ICCBased":
+        return ICC_MODES.get(get(space[1].getObject(), "/N"))
+
+    return COLOR_MODES.get(space)
 
 
-def get_images(path, guard_fn=default_guard):
+def get_images(path, guard_fn=default_guard, max_bytes=MAX_DECODED_BYTES):
+    """Generates the images in the PDF at `path` as tuples of (file-like object,
+    extension, width, height). JPEG images are passed through without being
+    decoded. Other images are decoded one at a time and encoded as PNG.
+
+    Images that appear more than once, either as the same object or with
+    identical contents, are only produced once. Once the estimated decoded
+    size of the images reaches `max_bytes`, no more images are decoded.
+    """
+    seen_keys = set()
+    seen_hashes = set()
+    decoded_bytes = 0
+
     with open(path, "rb") as infile:
         pdf = PdfFileReader(infile)
-        for (xid, xobject) in xobjects(pdf):
+        for (key, xobject) in xobjects(pdf, seen_keys):
+            if key:
+                seen_keys.add(key)
+
             if xobject["/Subtype"] != "/Image":
                 continue
 
             if guard_fn and not guard_fn(xobject):
                 continue
 
-            filter = xobject["/Filter"]
+            filter = image_filter(xobject)
             width = xobject["/Width"]
             height = xobject["/Height"]
 
-            if filter == "/FlateDecode":
-                data = xobject.getData()
-                mode = "RGB" if xobject["/ColorSpace"] == "/DeviceRGB" else "P"
-                yield (Image.frombytes(mode, (width, height), data), "png", width, height)
-            elif filter == "/DCTDecode":
-                #
+            if filter == "/DCTDecode":
+                # pylint: disable=protected-access
+                data = xobject._data
+                # pylint: enable=protected-access
+            elif filter == "/FlateDecode":
+                mode = color_mode(xobject)
+                if not mode:
+                    continue
+                size = width * height * mode[1]
+                if decoded_bytes + size > max_bytes:
+                    continue
                 # pylint: disable=protected-access
                 data = xobject._data
                 # pylint: enable=protected-access
-                yield (Image.open(BytesIO(data)), "jpeg", width, height)
             else:
                 continue
 
+            digest = hashlib.sha1(data).digest()
+            if digest in seen_hashes:
+                continue
+            seen_hashes.add(digest)
+
+            if filter == "/DCTDecode":
+                yield (BytesIO(data), "jpg", width, height)
+                continue
+
+            decoded_bytes += size
+            image = Image.frombytes(mode[0], (width, height),
+                                    xobject.getData())
+            if image.mode == "CMYK":
+                image = image.convert("RGB")
+            image_out = BytesIO()
+            image.save(image_out, "png")
+            image_out.seek(0)
+            yield (image_out, "png", width, height)
+
 
 def extract_images(path, filter_fn=default_guard, limit=10):
     limit -= 1
-    for i, (image, ext, width, height) in enumerate(get_images(path, filter_fn)):
-        image_out = BytesIO()
-        image.save(image_out, ext)
-        image_out.seek(0)
-        yield (image_out, ext, width, height)
+    for i, image in enumerate(get_images(path, filter_fn)):
+        yield image
 
         if i == limit:
             break
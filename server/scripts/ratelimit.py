@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter. Allows bursts of up to `capacity`
+    calls, refilling at `rate` tokens per second.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        "Block until a token is available, then consume it."
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
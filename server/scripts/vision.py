@@ -1,11 +1,15 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import threading
 from collections import OrderedDict
 from io import BytesIO
 from math import sqrt
 from urllib.request import urlopen
 
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
 from httplib2 import ServerNotFoundError
 from oauth2client.client import (ApplicationDefaultCredentialsError,
                                  GoogleCredentials)
@@ -31,48 +35,86 @@ except (ApplicationDefaultCredentialsError, ServerNotFoundError) as exc:
     CLIENT = None
 
 
-def image_similarity(image_path_a, image_path_b):
-    image_a = Image.open(image_path_a)
-    image_b = Image.open(image_path_b)
-    (wA, hA) = image_a.width, image_a.height
-    (wB, hB) = image_b.width, image_b.height
+def dhash(image_file, size=8):
+    """Calculate a perceptual 'difference hash' of an image. Resized, recompressed,
+    or slightly altered copies of an image have hashes that differ in only a
+    few bits.
+
+    :param image_file: path or file-like object
+    :param size: the hash has size*size bits
+
+    :returns: the hash as an int
+    """
+    image = Image.open(image_file)
+    # Let the decoder do most of the downscaling when it can (JPEG):
+    image.draft("L", (size * 8, size * 8))
+    pixels = list(image.convert("L")
+                  .resize((size + 1, size), Image.ANTIALIAS)
+                  .getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            value = (value << 1) | (pixels[i] > pixels[i + 1])
+
+    return value
+
 
-    if abs(wA/hA - wB/hB) > 0.1:
-        return 0
+def hash_distance(hash_a, hash_b):
+    "The number of bits that differ between two hashes."
+    return bin(hash_a ^ hash_b).count("1")
 
-    scaleA = min()
 
-    a_gray = image_a.convert("LA")
-    b_gray = image_b.convert("LA")
+def image_similarity(image_path_a, image_path_b):
+    """Returns a number between 0 and 1 indicating how similar two images
+    appear, where 1 means that they are (nearly) identical.
+    """
+    return 1 - hash_distance(dhash(image_path_a), dhash(image_path_b)) / 64
 
 
 def encode_image(image_file):
     return base64.b64encode(image_file.read()).decode("ascii")
 
 
-def annotate_image(client, image_file):
+FEATURES = [{
+    "type": "LABEL_DETECTION",
+}, {
+    "type": "LOGO_DETECTION",
+    "max_results": 1
+}, {
+    "type": "TEXT_DETECTION"
+}, {
+    "type": "IMAGE_PROPERTIES"
+}]
+
+# The API accepts at most 16 images per request:
+MAX_BATCH_SIZE = 16
+# Keep the encoded images in a request well below the API's size limit:
+MAX_BATCH_BYTES = 8 * 2**20
+
+
+def annotate_request(image_file):
     # TODO: Provide an image context with latLongRect (?)
-    body = {
-        "requests": [{
-            "image": {
-                "content": encode_image(image_file)
-            },
-            "features": [{
-                "type": "LABEL_DETECTION",
-            }, {
-                "type": "LOGO_DETECTION",
-                "max_results": 1
-            }, {
-                "type": "TEXT_DETECTION"
-            }, {
-                "type": "IMAGE_PROPERTIES"
-            }]
-        }]
-    }
+    return {"image": {"content": encode_image(image_file)},
+            "features": FEATURES}
+
+
+def annotate_image(client, image_file):
+    body = {"requests": [annotate_request(image_file)]}
     request = client.images().annotate(body=body)
     return request.execute()
 
 
+def annotate_images(client, image_files):
+    """Annotate several images with a single request.
+
+    :returns: a list of responses, in the same order as `image_files`
+    """
+    body = {"requests": [annotate_request(f) for f in image_files]}
+    request = client.images().annotate(body=body)
+    return request.execute()["responses"]
+
+
 def find_logo(response, full_width=None, full_height=None):
     """
     Performs some extra processing on the results returned from Google Vision
@@ -180,14 +222,8 @@ def open_image(image_path=None, image_url=None):
     return BytesIO(urlopen(image_url).read())
 
 
-def process_image(image_path=None, image_url=None):
-    assert image_path or image_url
-    if not CLIENT:
-        return None
-
+def summarize(response, image_url=None):
     try:
-        with open_image(image_path, image_url) as infile:
-            response = annotate_image(CLIENT, infile)["responses"][0]
         textual = find_textual(response)
         is_empty_streetview = image_url and is_streetview_url(image_url) and textual
         return {"logo": find_logo(response),
@@ -197,3 +233,81 @@ def process_image(image_path=None, image_url=None):
                 "empty_streetview": is_empty_streetview}
     except KeyError:
         return None
+
+
+def process_image(image_path=None, image_url=None):
+    assert image_path or image_url
+    if not CLIENT:
+        return None
+
+    with open_image(image_path, image_url) as infile:
+        response = annotate_image(CLIENT, infile)["responses"][0]
+    return summarize(response, image_url)
+
+
+_local = threading.local()
+
+
+def thread_client():
+    "The API client is not thread safe, so each thread creates its own."
+    if not hasattr(_local, "client"):
+        _local.client = get_client()
+    return _local.client
+
+
+def batches(images, batch_size):
+    batch = []
+    batch_bytes = 0
+    for i, (image_path, image_url) in enumerate(images):
+        size = os.path.getsize(image_path) if image_path else 0
+        if batch and (len(batch) >= batch_size or
+                      batch_bytes + size > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(i)
+        batch_bytes += size
+
+    if batch:
+        yield batch
+
+
+def process_images(images, batch_size=MAX_BATCH_SIZE, concurrency=4):
+    """Send several images to the Vision API, grouped into as few requests as
+    possible, with at most `concurrency` requests in flight at a time.
+
+    :param images: a list of (image_path, image_url) tuples
+
+    :returns: a tuple (results, failed). `results` is a list of the processed
+    results (see process_image) in the same order as `images`, with None for
+    any image that could not be processed. `failed` is a list of the indices
+    of the images whose requests failed, which may succeed if retried.
+    """
+    results = [None] * len(images)
+    failed = []
+    if not CLIENT:
+        return results, failed
+
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+
+    def process_batch(indices):
+        files = [open_image(*images[i]) for i in indices]
+        try:
+            responses = annotate_images(thread_client(), files)
+        finally:
+            for f in files:
+                f.close()
+        for i, response in zip(indices, responses):
+            results[i] = summarize(response, images[i][1])
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = [(indices, executor.submit(process_batch, indices))
+                   for indices in batches(images, batch_size)]
+        for indices, future in futures:
+            try:
+                future.result()
+            except (HttpError, OSError) as exc:
+                logging.warning("Vision API request failed: %s", exc)
+                failed.extend(indices)
+
+    return results, failed
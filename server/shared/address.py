@@ -38,7 +38,10 @@ def split_address(s):
 def normalize_address(s):
     # Could try using 'select normalize_address()' from PostGIS, which is
     # certainly more robust.
-    number, street = split_address(s)
+    split = split_address(s)
+    if not split:
+        return normalize_street(s)
+    number, street = split
     return "{} {}".format(normalize_number(number),
                           normalize_street(street))
 
@@ -2,8 +2,17 @@ from datetime import datetime
 import os
 import re
 import subprocess
+import unicodedata
 import utils
 
+from PIL import Image
+
+try:
+    # PyMuPDF, used to process PDFs in-process when available
+    import fitz
+except ImportError:
+    fitz = None
+
 
 class multimethod(object):
     class DispatchValueError(ValueError):
@@ -49,40 +58,152 @@ def extension(path, *_):
 published_date = multimethod(extension)
 published_date.default(lambda _: None)
 
+# Extracted text is always written as UTF-8, but files written before that was
+# the case may have a different encoding.
 encoding = multimethod(extension)
 encoding.default(lambda _: "utf-8")
 
+# Writes the text of a file as normalized UTF-8, with pages separated by form
+# feeds. Returns a list of page offsets (see write_pages), or None on failure.
 extract_text = multimethod(extension)
 
 extract_images = multimethod(extension)
 
-# PDF
-@published_date.add("pdf")
-def published_date(path):
-    proc = subprocess.Popen(["pdfinfo", path],
-                            stderr=subprocess.PIPE,
-                            stdout=subprocess.PIPE)
-    out, err = proc.communicate()
-    m = re.search(r"CreationDate:\s+(.*?)\n", out.decode("UTF-8"))
+# Extracts text, metadata, and a first-page thumbnail, opening the file once
+# if possible. Returns a dict with the keys 'published', 'pages', and
+# 'thumbnail', or None on failure.
+extract = multimethod(extension)
+extract.default(lambda *_: None)
+
+render_thumbnail = multimethod(extension)
+render_thumbnail.default(lambda *_: None)
+
 
+def parse_pdf_date(datestr):
+    """Parses a PDF date string (e.g., D:20170502120000-04'00').
+    """
+    m = re.match(r"(?:D:)?(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?",
+                 datestr or "")
     if m:
-        datestr = m.group(1)
-        return datetime.strptime(datestr, "%c")
+        year, month, day, *time = m.groups()
+        return datetime(int(year), int(month or 1), int(day or 1),
+                        *(int(t or 0) for t in time))
 
-    return datetime.fromtimestamp(os.path.getmtime(path))
 
+def write_pages(pages, output_path):
+    """Write an iterable of page texts to `output_path` as NFC-normalized UTF-8,
+    terminating each page with a form feed.
 
-# TODO: It may be practical to sniff pdfinfo, determine the PDF
-# producer used, and make a best guess at encoding based on that
-# information. We should be able to get away with using ISO-8859-9
-# for now.
-@encoding.add("pdf")
-def encoding(_):
-    return "ISO-8859-9"
+    :returns: a list of the byte offsets at which each page begins, followed
+    by the size of the file
+    """
+    offsets = [0]
+    with open(output_path, "wb") as out:
+        for page in pages:
+            data = (unicodedata.normalize("NFC", page).rstrip("\f") + "\f")\
+                .encode("utf-8")
+            out.write(data)
+            offsets.append(offsets[-1] + len(data))
 
+    return offsets
 
-@extract_text.add("pdf")
-def extract_text(path, output_path):
-    status = subprocess.call(["pdftotext", "-enc", encoding(path), path,
-                              output_path])
-    return not status
+
+def thumbnail_zoom(rect, size):
+    return size / max(rect.width, rect.height)
+
+
+# PDF
+if fitz:
+    def pdf_extract(path, text_path, thumbnail_path=None, thumbnail_size=200):
+        with fitz.open(path) as pdf:
+            offsets = write_pages((page.get_text() for page in pdf), text_path)
+
+            thumbnail = None
+            if thumbnail_path and pdf.page_count:
+                page = pdf[0]
+                zoom = thumbnail_zoom(page.rect, thumbnail_size)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom),
+                                      alpha=False)
+                Image.frombytes("RGB", (pix.width, pix.height), pix.samples)\
+                     .save(thumbnail_path, "JPEG")
+                thumbnail = thumbnail_path
+
+            return {"published": parse_pdf_date(
+                        pdf.metadata.get("creationDate")),
+                    "pages": offsets,
+                    "thumbnail": thumbnail}
+
+    @published_date.add("pdf")
+    def published_date(path):
+        with fitz.open(path) as pdf:
+            published = parse_pdf_date(pdf.metadata.get("creationDate"))
+        return published or datetime.fromtimestamp(os.path.getmtime(path))
+
+    @extract_text.add("pdf")
+    def extract_text(path, output_path):
+        result = pdf_extract(path, output_path)
+        return result and result["pages"]
+
+    @render_thumbnail.add("pdf")
+    def render_thumbnail(path, output_path, size=200):
+        with fitz.open(path) as pdf:
+            page = pdf[0]
+            zoom = thumbnail_zoom(page.rect, size)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            Image.frombytes("RGB", (pix.width, pix.height), pix.samples)\
+                 .save(output_path, "JPEG")
+        return output_path
+
+    extract.add("pdf", pdf_extract)
+else:
+    @published_date.add("pdf")
+    def published_date(path):
+        proc = subprocess.Popen(["pdfinfo", path],
+                                stderr=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        out, err = proc.communicate()
+        m = re.search(r"CreationDate:\s+(.*?)\n", out.decode("UTF-8"))
+
+        if m:
+            datestr = m.group(1)
+            return datetime.strptime(datestr, "%c")
+
+        return datetime.fromtimestamp(os.path.getmtime(path))
+
+    @extract_text.add("pdf")
+    def extract_text(path, output_path):
+        status = subprocess.call(["pdftotext", "-enc", "UTF-8", path,
+                                  output_path])
+        if status:
+            return None
+
+        with open(output_path, "r", encoding="utf-8", errors="replace",
+                  newline="") as text_in:
+            pages = text_in.read().split("\f")
+        if pages and not pages[-1]:
+            pages.pop()
+
+        return write_pages(pages, output_path)
+
+    @render_thumbnail.add("pdf")
+    def render_thumbnail(path, output_path, size=200):
+        out_prefix, _ = os.path.splitext(output_path)
+        proc = subprocess.Popen(
+            ["pdftoppm", "-jpeg", "-singlefile", "-scale-to", str(size), path,
+             out_prefix],
+            stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+
+        if proc.returncode:
+            raise Exception("pdftoppm failed for %s" % path, err)
+
+        return out_prefix + os.path.extsep + "jpg"
+
+    @extract.add("pdf")
+    def extract(path, text_path, thumbnail_path=None, thumbnail_size=200):
+        offsets = extract_text(path, text_path)
+        if offsets:
+            # Thumbnails are generated separately
+            return {"published": published_date(path),
+                    "pages": offsets,
+                    "thumbnail": None}
@@ -1,18 +1,98 @@
+import re
+
 from django.conf import settings
+from django.core.cache import cache
 
 from django.contrib.gis.geos import Point
 
-from scripts import gmaps, arcgis
+from scripts import gmaps, arcgis, parcelcoder
+from scripts.geocoding import NO_MATCH
+from shared.address import normalize_address
+
+
+def cache_key(addr, region=None):
+    """Builds a cache key from an address string of the form '<street address>,
+    <region>', as constructed by utils.add_locations.
+
+    """
+    address, _, addr_region = addr.partition(",")
+    region = " ".join(filter(None, [addr_region, region]))
+    region = re.sub(r"[\s,.]+", " ", region).strip().upper()
+    return f"geocode:{normalize_address(address)}|{region}"
+
+
+class CachedGeocoder(object):
+    """Wraps a geocoder, storing its results in the cache. Only addresses that are
+    not already in the cache are sent to the wrapped geocoder, in a single call.
+
+    Addresses that the geocoder reports as having no match are also cached, but
+    for a shorter time (`negative_ttl`), so that bad addresses are not
+    resubmitted on every import. Failed lookups are not cached.
+    """
+    # Stored in place of a result when the geocoder could not find an address:
+    MISSING = "missing"
+
+    def __init__(self, geocoder, ttl=None, negative_ttl=None):
+        self.geocoder = geocoder
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def __getattr__(self, attr):
+        return getattr(self.geocoder, attr)
+
+    def geocode(self, addrs, **kwargs):
+        if isinstance(addrs, str):
+            addrs = [addrs]
+        addrs = list(addrs)
+        keys = [cache_key(addr, kwargs.get("region")) for addr in addrs]
+        cached = cache.get_many(keys)
+
+        misses = {}
+        for addr, key in zip(addrs, keys):
+            if key not in cached:
+                misses.setdefault(key, addr)
+
+        if misses:
+            results = self.geocoder.geocode(list(misses.values()), **kwargs)
+            found = {}
+            missing = {}
+            for key, result in zip(misses, results):
+                if result:
+                    found[key] = result
+                elif result is NO_MATCH:
+                    missing[key] = self.MISSING
+            cache.set_many(found, self.ttl)
+            cache.set_many(missing, self.negative_ttl)
+            cached.update(found)
+
+        return [None if cached.get(key) == self.MISSING else cached.get(key)
+                for key in keys]
+
+
+def make_geocoder(name):
+    if name == "google":
+        geocoder = gmaps.GoogleGeocoder(settings.GOOGLE_API_KEY,
+                                        parallelism=settings.GEOCODER_PARALLELISM,
+                                        qps=settings.GEOCODER_QPS)
+        geocoder.bounds = settings.GEO_BOUNDS
+        return geocoder
+    elif name == "arcgis":
+        return arcgis.ArcGISCoder(settings.ARCGIS_CLIENT_ID,
+                                  settings.ARCGIS_CLIENT_SECRET,
+                                  parallelism=settings.GEOCODER_PARALLELISM)
+    elif name == "parcel":
+        return parcelcoder.ParcelGeocoder(
+            make_geocoder(settings.GEOCODER_FALLBACK))
+
+    return None
+
 
+Geocoder = make_geocoder(settings.GEOCODER)
 
-if settings.GEOCODER == "google":
-    Geocoder = gmaps.GoogleGeocoder(settings.GOOGLE_API_KEY)
-    Geocoder.bounds = settings.GEO_BOUNDS
-elif settings.GEOCODER == "arcgis":
-    Geocoder = arcgis.ArcGISCoder(settings.ARCGIS_CLIENT_ID,
-                                  settings.ARCGIS_CLIENT_SECRET)
-else:
-    Geocoder = None
+if Geocoder and settings.GEOCODE_CACHE:
+    Geocoder = CachedGeocoder(Geocoder,
+                              ttl=settings.GEOCODE_CACHE_TTL,
+                              negative_ttl=settings.GEOCODE_NEGATIVE_TTL)
 
 
 def as_point(geo_response):
@@ -1,9 +1,11 @@
 from django.contrib import messages
 from django.urls import reverse
 from django.core.serializers.json import DjangoJSONEncoder
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
 from django.shortcuts import redirect, render_to_response, render
 
+import hashlib
 import logging
 import json
 import re
@@ -23,17 +25,55 @@ class ErrorResponse(Exception):
         self.redirect_back = redirect_back
 
 
+def wants_json(req, template=None):
+    accepts = req.META.get("HTTP_ACCEPT", "text/html")
+    return not template \
+        or re.search(r"application/json", accepts) \
+        or req.GET.get("format", "").lower() == "json"
+
+
+def if_none_match(req):
+    header = req.META.get("HTTP_IF_NONE_MATCH", "")
+    return {tag.strip() for tag in header.split(",") if tag.strip()}
+
+
 def make_response(template=None, error_template="error.djhtml",
-                  shared_context=None, redirect_back=False):
+                  shared_context=None, redirect_back=False, etag=None):
     """
     View decorator
 
     Tailor the response to the requested data type, as specified
     in the Accept header. Expects the wrapped view to return a
     dict. If the request wants JSON, renders the dict as JSON data.
+
+    If `etag` is given, it is called with the view's arguments and should
+    return a string that changes whenever the response would. JSON responses
+    then carry an ETag, and requests with a matching If-None-Match header
+    receive a 304 without running the view.
     """
     def constructor_fn(view):
         def wrapped_view(req, *args, **kwargs):
+            jsonp_callback = req.GET.get("callback")
+            tag = None
+            # HTML responses may depend on the user, so they are not tagged
+            if etag and (jsonp_callback or wants_json(req, template)):
+                kind = "js:" + jsonp_callback if jsonp_callback else "json"
+                digest = hashlib.sha1(
+                    f"{etag(req, *args, **kwargs)}|{kind}".encode())
+                tag = f'W/"{digest.hexdigest()}"'
+                matches = if_none_match(req)
+                if tag in matches or "*" in matches:
+                    response = HttpResponseNotModified()
+                    response["ETag"] = tag
+                    return response
+
+            response = render_response(req, *args, **kwargs)
+            if tag and response.status_code == 200:
+                response["ETag"] = tag
+                patch_vary_headers(response, ["Accept"])
+            return response
+
+        def render_response(req, *args, **kwargs):
             use_template = template
             status = 200
             should_redirect_back = redirect_back
@@ -64,11 +104,7 @@ def make_response(template=None, error_template="error.djhtml",
                 response["Content-type"] = "application/javascript"
                 return response
 
-            accepts = req.META.get("HTTP_ACCEPT", "text/html")
-
-            if not use_template \
-               or re.search(r"application/json", accepts) \
-               or req.GET.get("format", "").lower() == "json":
+            if wants_json(req, use_template):
                 response = JsonResponse(data, status=status)
                 response["Access-Control-Allow-Origin"] = "*"
                 return response
@@ -1,10 +1,27 @@
+import io
+import json
+import tempfile
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs
+import zlib
+
 from django.test import Client, TestCase, tag, override_settings
 
 from django.contrib.auth import get_user_model
 
 from user.models import Subscription, UserProfile
 
-from .geocoder import Geocoder
+from PIL import Image
+from PyPDF2 import PdfFileWriter
+from PyPDF2.generic import (DictionaryObject, EncodedStreamObject, NameObject,
+                            NumberObject)
+import requests
+
+from scripts import arcgis, gmaps, parcelcoder, pdf
+
+from . import files
+from .address import normalize_number, normalize_street
+from .geocoder import Geocoder, cache_key
 from .staff_notifications import UserNotificationForm
 import utils
 
@@ -73,3 +90,193 @@ class UtilitiesTests(TestCase):
                 .startswith("http://localhost:4000/hello"))
             self.assertEqual(utils.make_absolute_url("http://google.com"),
                              "http://google.com")
+
+    def test_geocode_cache_key(self):
+        self.assertEqual(cache_key("93 Highland Avenue, Somerville, MA"),
+                         cache_key("93  highland ave,somerville, ma"))
+        self.assertNotEqual(cache_key("93 Highland Ave, Somerville, MA"),
+                            cache_key("93 Highland Ave, Cambridge, MA"))
+
+    def test_write_pages(self):
+        with tempfile.NamedTemporaryFile() as text_file:
+            offsets = files.write_pages(["Café\n", "Page 2\n"],
+                                        text_file.name)
+            data = text_file.read()
+
+        self.assertEqual(len(offsets), 3)
+        self.assertEqual(offsets[-1], len(data))
+        self.assertEqual(data[offsets[1]:offsets[2]].decode("utf-8"),
+                         "Page 2\n\f")
+        self.assertEqual(data[:offsets[1]].decode("utf-8"), "Café\n\f")
+
+
+def gmaps_response(address):
+    number = int(address.split()[0])
+    return {"status": "OK",
+            "results": [{"geometry": {"location": {"lat": number,
+                                                   "lng": -number}},
+                         "formatted_address": address,
+                         "place_id": str(number),
+                         "types": ["street_address"]}]}
+
+
+def json_body(data):
+    return io.BytesIO(json.dumps(data).encode("utf-8"))
+
+
+@tag("geocoder")
+class GeocoderTests(TestCase):
+    def test_google_threaded(self):
+        def get(url, params):
+            if params["address"].startswith("13 "):
+                raise requests.ConnectionError()
+            return mock.Mock(json=lambda: gmaps_response(params["address"]))
+
+        addrs = [f"{n} Highland Ave" for n in range(1, 21)]
+        geocoder = gmaps.GoogleGeocoder("key", parallelism=4, qps=1000)
+        with mock.patch.object(gmaps.requests, "get", side_effect=get):
+            results = geocoder.geocode(addrs)
+
+        self.assertEqual(len(results), len(addrs))
+        self.assertIsNone(results[12])
+        for addr, result in zip(addrs[:12] + addrs[13:],
+                                results[:12] + results[13:]):
+            self.assertEqual(result["formatted_name"], addr)
+
+    def test_arcgis_batches(self):
+        tokens = []
+        batches = []
+
+        def urlopen(url, data):
+            if url == arcgis.TOKEN_URL:
+                tokens.append(f"token-{len(tokens)+1}")
+                return json_body({"access_token": tokens[-1],
+                                  "expires_in": 7200})
+
+            params = parse_qs(data.decode("ISO-8859-1"))
+            if params["token"] == ["token-1"]:
+                return json_body({"error": {"code": 498}})
+            records = json.loads(params["addresses"][0])["records"]
+            batches.append(len(records))
+            return json_body({"locations": [
+                {"location": {"x": -r["attributes"]["OBJECTID"],
+                              "y": r["attributes"]["OBJECTID"]},
+                 "attributes": {"ResultID": r["attributes"]["OBJECTID"],
+                                "Status": "M",
+                                "Match_addr": r["attributes"]["Address"],
+                                "Addr_type": "PointAddress"},
+                 "score": 100}
+                for r in reversed(records)]})
+
+        info = {"locatorProperties": {"MaxBatchSize": 2}}
+        addrs = [f"{n} Highland Ave" for n in range(1, 6)]
+        geocoder = arcgis.ArcGISCoder("id", "secret", parallelism=3)
+        with mock.patch.object(arcgis, "urlopen", side_effect=urlopen), \
+             mock.patch.object(arcgis.requests, "get",
+                               return_value=mock.Mock(json=lambda: info)):
+            results = geocoder.geocode(addrs)
+
+        self.assertEqual(sorted(batches), [1, 2, 2])
+        self.assertEqual(tokens, ["token-1", "token-2"])
+        self.assertEqual([r["formatted_name"] for r in results], addrs)
+
+    def test_parcel_fallback(self):
+        key = (274, normalize_number("93"), normalize_street("Highland Ave"))
+        index = {key: (1, -71.1, 42.39, "93 Highland Ave")}
+        fallback = mock.Mock()
+        fallback.geocode.return_value = [{"formatted_name": "fallback"}]
+
+        geocoder = parcelcoder.ParcelGeocoder(fallback)
+        with mock.patch.object(geocoder, "build_index", return_value=index):
+            hit, miss = geocoder.geocode(
+                ["93 Highland Avenue, Somerville, MA",
+                 "1 Elm St, Somerville, MA"])
+
+        self.assertEqual(hit["properties"]["parcel_id"], 1)
+        self.assertEqual(hit["location"], {"lat": 42.39, "lng": -71.1})
+        fallback.geocode.assert_called_once_with(["1 Elm St, Somerville, MA"])
+        self.assertEqual(miss, {"formatted_name": "fallback"})
+
+
+def image_stream(color, width=200, height=200, jpeg=False):
+    """Builds an RGB image XObject filled with a single color, compressed with
+    Flate or, if `jpeg` is True, encoded as a JPEG.
+    """
+    if jpeg:
+        data = io.BytesIO()
+        Image.new("RGB", (width, height), color).save(data, "jpeg")
+        data, image_filter = data.getvalue(), "/DCTDecode"
+    else:
+        data, image_filter = zlib.compress(bytes(color) * width * height), \
+                             "/FlateDecode"
+    stream = EncodedStreamObject()
+    stream._data = data
+    stream.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(width),
+        NameObject("/Height"): NumberObject(height),
+        NameObject("/ColorSpace"): NameObject("/DeviceRGB"),
+        NameObject("/BitsPerComponent"): NumberObject(8),
+        NameObject("/Filter"): NameObject(image_filter)})
+    return stream
+
+
+def write_pdf(writer, pages):
+    """Adds a page to `writer` for each list of image references in `pages`,
+    then writes the PDF to a temporary file.
+
+    :returns: the open temporary file
+    """
+    for refs in pages:
+        page = writer.addBlankPage(612, 792)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/XObject"): DictionaryObject({
+                NameObject(f"/Im{i}"): ref for i, ref in enumerate(refs)})})
+
+    pdf_file = tempfile.NamedTemporaryFile(suffix=".pdf")
+    writer.write(pdf_file)
+    pdf_file.flush()
+    return pdf_file
+
+
+@tag("files")
+class PdfTests(TestCase):
+    def setUp(self):
+        # The red image appears twice as the same object, and once more as a
+        # separate object with the same contents:
+        writer = PdfFileWriter()
+        red = writer._addObject(image_stream((255, 0, 0)))
+        blue = writer._addObject(image_stream((0, 0, 255)))
+        red_copy = writer._addObject(image_stream((255, 0, 0)))
+        pdf_file = write_pdf(writer, [[red, blue], [red, red_copy]])
+        self.addCleanup(pdf_file.close)
+        self.path = pdf_file.name
+
+    def test_repeated_images(self):
+        images = list(pdf.get_images(self.path))
+        self.assertEqual([(ext, w, h) for _, ext, w, h in images],
+                         [("png", 200, 200)] * 2)
+        self.assertEqual([Image.open(data).getpixel((0, 0))
+                          for data, *_ in images],
+                         [(255, 0, 0), (0, 0, 255)])
+
+    def test_streaming(self):
+        with mock.patch.object(pdf.Image, "frombytes",
+                               wraps=Image.frombytes) as frombytes:
+            images = pdf.get_images(self.path)
+            next(images)
+            self.assertEqual(frombytes.call_count, 1)
+            images.close()
+
+    def test_memory_cap(self):
+        images = list(pdf.get_images(self.path, max_bytes=200 * 200 * 3))
+        self.assertEqual(len(images), 1)
+
+    @skipUnless(files.fitz, "PyMuPDF is not installed")
+    def test_pdf_extract(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            result = files.pdf_extract(self.path, f"{out_dir}/text.txt",
+                                       f"{out_dir}/thumb.jpg")
+            self.assertEqual(result["pages"], [0, 1, 2])
+            self.assertEqual(max(Image.open(result["thumbnail"]).size), 200)
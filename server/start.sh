@@ -43,7 +43,8 @@ start_celery() {
            --detach \
            --logfile=/var/log/celery/beat.log
     mkdir -p /var/run/celery /var/log/celery
-    celery multi start ${CELERY_WORKER_COUNT:-2} -A $APP_NAME -l "${CELERY_LOGLEVEL:-info}" $1 \
+    celery multi start ${CELERY_WORKER_COUNT:-2} -A $APP_NAME -l "${CELERY_LOGLEVEL:-info}" \
+           -Q "${CELERY_QUEUES:-celery,network,cpu,api}" $1 \
            --pidfile=/var/run/celery/%n.pid \
            --logfile=/var/log/celery/%n.log
 }
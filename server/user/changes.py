@@ -1,15 +1,90 @@
 from collections import defaultdict, OrderedDict
 
+from django.db.models import Q
 from django.forms.models import model_to_dict
 
 from proposal.models import Changeset, Document, Image, Proposal, Event
-from proposal.views import proposal_json
+from proposal.views import proposals_json
 from proposal.query import build_proposal_query_dict
 
 
-def summarize_query_updates(query_dict, since=None, until=None):
+class ChangeIndex:
+    """Serialized proposals, along with their changesets, documents, and images
+    since a given date (or all of them, if `since` is None). Summaries for
+    many queries can share an index, so that each proposal is loaded and
+    serialized once per run, no matter how many queries include it.
+    """
+    def __init__(self, since, until=None):
+        self.since = since
+        self.until = until
+        self.proposals = {}
+        self.changesets = defaultdict(list)
+        self.documents = defaultdict(list)
+        self.images = defaultdict(list)
+
+    def load(self, ids):
+        """Add the proposals with the given ids that are not already indexed.
+        """
+        ids = [pk for pk in ids if pk not in self.proposals]
+        if not ids:
+            return
+
+        for pdict in proposals_json(Proposal.objects.filter(pk__in=ids),
+                                    include_images=1,
+                                    include_documents=False):
+            self.proposals[pdict["id"]] = pdict
+
+        changesets = Changeset.objects.filter(proposal__in=ids)
+        if self.since:
+            changesets = changesets.filter(created__gt=self.since)
+        for change in changesets.order_by("created"):
+            self.changesets[change.proposal_id].append(
+                (change.created, change.changes))
+
+        for model, index in ((Document, self.documents),
+                             (Image, self.images)):
+            objects = model.objects.filter(proposal__in=ids)
+            if self.since:
+                objects = objects.filter(created__gt=self.since)
+            if self.until:
+                objects = objects.filter(created__lte=self.until)
+            for obj in objects:
+                index[obj.proposal_id].append((obj.created, obj.to_dict()))
+
+    def changes(self, pk, since=None):
+        """Describe the changes to an indexed proposal after `since` (if given),
+        which should not be earlier than the index's start date.
+        """
+        def after(created):
+            return not since or created > since
+
+        properties = []
+        attributes = []
+        for created, changes in self.changesets[pk]:
+            if after(created):
+                properties.extend(changes["properties"])
+                attributes.extend(changes["attributes"])
+
+        return {
+            "proposal": self.proposals[pk],
+            "new": False,
+            "properties": properties,
+            "attributes": attributes,
+            "documents": [d for created, d in self.documents[pk]
+                          if after(created)],
+            "images": [i for created, i in self.images[pk] if after(created)]
+        }
+
+
+def summarize_query_updates(query_dict, since=None, until=None,
+                            proposal_ids=None, index=None):
     """Takes a proposal query dict and a range of dates. Constructs a dictionary
-    summarizing the changes that are relevant to that query.
+    summarizing the changes that are relevant to that query. If
+    `proposal_ids` is given, only those proposals are considered.
+
+    Proposals are serialized using `index`, a ChangeIndex, if one is given.
+    When summarizing the updates for several queries, passing the same index
+    avoids repeating the work for proposals that appear in more than one.
 
     Returns a dictionary with the following structure:
 
@@ -25,82 +100,45 @@ def summarize_query_updates(query_dict, since=None, until=None):
     - "start"/"end": numeric timestamps indicating start and end
 
     """
+    index = index or ChangeIndex(since, until)
+    since = since or index.since
+
+    matching = Proposal.objects.filter(**query_dict)
     if since:
-        query_dict["created__gt"] = since
-    # Find proposals that are NEW since the given date:
-    proposals = Proposal.objects.filter(**query_dict)
-    new_ids = {proposal.pk for proposal in proposals}
-
-    # Find proposals that have *changed*, but which are not new:
-    proposals_changed = Proposal.objects\
-                                .exclude(pk__in=new_ids)\
-                                .filter(updated__gt=since, **query_dict)
-    if until:
-        proposals_changed = proposals_changed.filter(updated__lte=until)
+        matching = matching.filter(Q(created__gt=since) |
+                                   Q(updated__gt=since))
+    if proposal_ids is not None:
+        matching = matching.filter(pk__in=proposal_ids)
+    rows = list(matching.values_list("pk", "created", "updated"))
+
+    # Proposals that are NEW since the given date (or all of them, if there
+    # is no date):
+    new_ids = [pk for pk, created, _ in rows if not since or created > since]
+    # Proposals that have *changed*, but which are not new:
+    changed_ids = [pk for pk, created, updated in rows
+                   if since and created <= since and
+                   not (until and updated > until)]
+    index.load(new_ids + changed_ids)
 
     # Start with the new proposals:
-    summary = OrderedDict((p.id, {
-        "proposal": proposal_json(
-            p, include_images=1, include_documents=False),
+    summary = OrderedDict((pk, {
+        "proposal": index.proposals[pk],
         "new": True
-    }) for p in proposals)
-
-    if proposals_changed:
-        # Only include changesets for proposals we're interested in:
-        ids = [proposal.pk for proposal in proposals_changed]
-        changes = Changeset.objects.filter(created__gt=since,
-                                           proposal__in=ids)\
-                                   .order_by("created")
-
-        prop_changes = defaultdict(list)
-        attr_changes = defaultdict(list)
-        for change in changes:
-            change_dict = change.changes
-            pchange_list = prop_changes[change.proposal_id]
-            achange_list = attr_changes[change.proposal_id]
-            pchange_list.extend(change_dict["properties"])
-            achange_list.extend(change_dict["attributes"])
-
-        for p in proposals_changed:
-            summary[p.id] = {
-                "proposal": proposal_json(
-                    p, include_images=1, include_documents=False),
-                "new": False,
-                "properties": prop_changes[p.id],
-                "attributes": attr_changes[p.id],
-                "documents": [],
-                "images": []
-            }
-
-    # Find new Documents:
-    documents = Document.objects.filter(
-        proposal__in=proposals_changed, created__gt=since)
-    if until:
-        documents = documents.filter(updated__lte=until)
-
-    for doc in documents:
-        if doc.proposal_id in summary:
-            summary[doc.proposal_id]["documents"].append(doc.to_dict())
-
-    # Find new Images:
-    images = Image.objects.filter(
-        proposal__in=proposals_changed, created__gt=since)
-    if until:
-        images = images.filter(updated__lte=until)
+    }) for pk in new_ids)
 
-    for image in images:
-        if image.proposal_id in summary:
-            summary[image.proposal_id]["images"].append(image.to_dict())
+    for pk in changed_ids:
+        summary[pk] = index.changes(pk, since)
 
     return {"changes": summary,
             "new": len(new_ids),
-            "updated": len(proposals_changed),
-            "total": len(new_ids) + len(proposals_changed),
-            "start": since.timestamp(),
-            "end": until.timestamp if until else None}
+            "updated": len(changed_ids),
+            "total": len(new_ids) + len(changed_ids),
+            "start": since.timestamp() if since else None,
+            "end": until.timestamp() if until else None}
 
 
-def summarize_subscription_updates(subscription, since, until=None):
+def summarize_subscription_updates(subscription, since, until=None,
+                                   proposal_ids=None, index=None):
     """Generates a dictionary describing the updates relevant to the given
     Subscription that occurred after `since` through `until` (if given).
 
@@ -108,6 +146,8 @@ def summarize_subscription_updates(subscription, since, until=None):
     dictionary suitabe for building a proposal query.
     :since: a datetime
     :until: datetime
+    :proposal_ids: if given, only these proposals are considered
+    :index: a ChangeIndex shared with other summaries
 
     :returns: a dictionary with the keys "changes", containing a dictionary
     mapping proposal ids to changes; "new", a count of the new proposals; and
@@ -121,7 +161,7 @@ def summarize_subscription_updates(subscription, since, until=None):
     query = build_proposal_query_dict(query_dict)
     # Don't include changes that predate the Subscription:
     since = max(subscription.created, since)
-    return summarize_query_updates(query, since, until)
+    return summarize_query_updates(query, since, until, proposal_ids, index)
 
 
 def summarize_event(event):
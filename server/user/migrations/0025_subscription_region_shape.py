@@ -0,0 +1,22 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0024_usercomment_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='region_shape',
+            field=django.contrib.gis.db.models.fields.PolygonField(editable=False, help_text='The notification region: the box, or the circle around the center', null=True, srid=4326),
+        ),
+        migrations.RunSQL(
+            "UPDATE user_subscription "
+            "SET region_shape = COALESCE(box, ST_Buffer(center, radius)::geometry)",
+            migrations.RunSQL.noop,
+        ),
+    ]
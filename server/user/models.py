@@ -4,7 +4,8 @@ from django.contrib.gis.db import models
 from django.contrib.gis.measure import D
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db.models import F, Q
+from django.db import connection
+from django.db.models import F, Func, Q
 from django.urls import reverse
 from django.utils import timezone
 
@@ -141,6 +142,32 @@ class SubscriptionQuerySet(models.QuerySet):
     def in_radius(self, point, radius):
         return self.filter(Q(center__distance_lte=(point, radius)))
 
+    def matching_proposals(self, proposals):
+        """Find the proposals that are inside the notification region of each
+        Subscription, using a single spatial join on the indexed
+        `region_shape`.
+
+        :param proposals: a Proposal queryset, typically of recently changed
+        proposals
+
+        :returns: a dict mapping Subscription pks to lists of Proposal pks.
+        Subscriptions with no matching proposals are omitted.
+        """
+        subs_sql, subs_params = self.order_by()\
+                                    .values("pk", "region_shape")\
+                                    .query.sql_with_params()
+        props_sql, props_params = proposals.order_by()\
+                                           .values("pk", "location")\
+                                           .query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT s.id, array_agg(p.id) FROM ({subs_sql}) s "
+                f"JOIN ({props_sql}) p "
+                "ON ST_Intersects(s.region_shape, p.location::geometry) "
+                "GROUP BY s.id",
+                tuple(subs_params) + tuple(props_params))
+            return dict(cursor.fetchall())
+
     def mark_sent(self):
         """Mark that the Subscriptions in the query set have been sent emails.
 
@@ -217,6 +244,13 @@ class Subscription(models.Model):
         max_length=256, default="", blank=True,
         help_text="Include events for a specified region")
     last_notified = models.DateTimeField(null=True)
+    # Derived from box or center and radius when the Subscription is saved.
+    # (Not to be confused with the `shape` property, which is approximate.)
+    region_shape = models.PolygonField(
+        help_text=("The notification region: the box, or the circle around "
+                   "the center"),
+        editable=False,
+        null=True)
 
     objects = SubscriptionQuerySet.as_manager()
 
@@ -231,7 +265,13 @@ class Subscription(models.Model):
 
     def save(self, *args, **kwargs):
         self.updated = datetime.now()
+        self.region_shape = self.box
         super().save(*args, **kwargs)
+        if self.center and not self.box:
+            # Buffering the geography center gives a radius in meters
+            Subscription.objects.filter(pk=self.pk).update(region_shape=Func(
+                "center", "radius", output_field=models.PolygonField(),
+                template="ST_Buffer(%(expressions)s)::geometry"))
 
     def clean(self):
         if bool(self.center) != bool(self.radius):  # nxor
@@ -262,16 +302,19 @@ class Subscription(models.Model):
     def deactivate(self):
         self.active = None
 
-    def summarize_updates(self, since=None, until=None):
+    def summarize_updates(self, since=None, until=None, proposal_ids=None,
+                          index=None):
         """
         since: a datetime
+        proposal_ids: if given, only these proposals are considered
+        index: a ChangeIndex shared with other Subscriptions' summaries
 
         :returns: a dictionary describing the changes to the query since the
         given datetime
         """
         return summarize_subscription_updates(self,
                                               since or self.updates_start_date,
-                                              until)
+                                              until, proposal_ids, index)
 
     def confirm_url(self, absolute=True):
         relative = "{base}?token={token}&uid={uid}&sub={sub_id}".format(
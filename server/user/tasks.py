@@ -3,6 +3,7 @@ import json
 
 from celery import shared_task
 from django.contrib.auth import get_user_model
+from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
@@ -16,7 +17,9 @@ from cornerwise.adapt import adapt
 import site_config
 
 import redis_utils as red
+from proposal.models import Proposal
 
+from .changes import ChangeIndex
 from .models import Subscription
 from . import mail
 
@@ -37,13 +40,16 @@ def send_user_updates(self, sub: Subscription, updates):
               logger=get_logger(self))
 
 
-def send_subscription_updates(subscription, since):
+def send_subscription_updates(subscription, since, proposal_ids=None,
+                              index=None):
     """If there are any recent changes relevant to the given Subscription,
     create a task to send email to the subscription owner.
     """
     if not since:
         since = subscription.last_notified
-    updates = subscription.summarize_updates(since)
+    updates = subscription.summarize_updates(since,
+                                             proposal_ids=proposal_ids,
+                                             index=index)
     if updates["total"]:
         send_user_updates.delay(subscription.pk, updates)
         return True
@@ -101,6 +107,12 @@ def send_notifications(self, subscription_ids=None, since=None):
     """Check the Subscriptions and find those that have new updates since the last
     update was run.
 
+    Rather than querying for each Subscription's updates, the proposals
+    changed since the earliest start date are matched against the
+    Subscriptions' regions in one spatial join. Only the Subscriptions with
+    matching proposals are summarized, and only those proposals are
+    considered. The summaries share a ChangeIndex, so each proposal is
+    serialized once per run.
     """
     logger = get_logger(self)
     if subscription_ids:
@@ -108,9 +120,26 @@ def send_notifications(self, subscription_ids=None, since=None):
     else:
         subscriptions = Subscription.objects.due(since)
 
+    subscriptions = list(subscriptions)
+    if not subscriptions:
+        logger.info("No updates sent")
+        return
+
+    start = min(max(sub.created,
+                    since or sub.last_notified or sub.updates_start_date)
+                for sub in subscriptions)
+    changed = Proposal.objects.filter(Q(created__gt=start) |
+                                      Q(updated__gt=start))
+    matches = Subscription.objects.filter(
+        pk__in=[sub.pk for sub in subscriptions]).matching_proposals(changed)
+
+    index = ChangeIndex(start)
+    index.load({pk for ids in matches.values() for pk in ids})
     sent = []
     for subscription in subscriptions:
-        if send_subscription_updates(subscription, since):
+        proposal_ids = matches.get(subscription.pk)
+        if proposal_ids and \
+           send_subscription_updates(subscription, since, proposal_ids, index):
             sent.append(subscription.pk)
 
     if sent:
@@ -5,14 +5,20 @@ from django.core import mail
 from django.core.exceptions import ValidationError
 
 from django.contrib.auth import authenticate, get_user_model
+from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
 
+from datetime import datetime, timedelta
 import json
 import random
 import re
 from urllib.parse import parse_qs, urlsplit
 
-from . import models, views, mail_parse_views
+import pytz
+
+from proposal.models import Proposal
+
+from . import changes, models, views, mail_parse_views
 from .models import Subscription, UserComment, UserProfile
 import site_config
 
@@ -200,6 +206,53 @@ class TestSubscribe(TestCase):
             subscription.set_validated_query(query)
 
 
+@tag("subscription", "notifications")
+class TestNotificationMatching(TestCase):
+    def test_matching_proposals(self):
+        user = User.objects.create(username="matching_test_user",
+                                   email="matching_test_user@example.com")
+        circle = Subscription(user=user, site_name="")
+        circle.set_validated_query({"center": "42.38,-71.1", "r": "300m"})
+        circle.save()
+        box = Subscription(user=user, site_name="")
+        box.set_validated_query({"box": "42.39,-71.09,42.40,-71.08"})
+        box.save()
+
+        now = datetime.now(pytz.utc)
+        inside, _ = [
+            Proposal.objects.create(
+                case_number=f"ZBA 2017-{i}", case_numbers=[f"ZBA 2017-{i}"],
+                address=f"{i} Cherry Street", location=location,
+                updated=now, started=now)
+            for i, location in enumerate([Point(-71.1005, 42.3805),
+                                          Point(-71.07, 42.37)])]
+
+        matches = Subscription.objects.all()\
+                                      .matching_proposals(Proposal.objects.all())
+        self.assertEqual(matches, {circle.pk: [inside.pk]})
+
+    def test_shared_change_index(self):
+        since = datetime.now(pytz.utc)
+        proposal = Proposal.objects.create(
+            case_number="ZBA 2017-1", case_numbers=["ZBA 2017-1"],
+            address="1 Cherry Street", location=Point(-71.1, 42.38),
+            updated=since, started=since)
+        index = changes.ChangeIndex(since - timedelta(days=1))
+        summaries = [
+            changes.summarize_query_updates({"address": "1 Cherry Street"},
+                                            since - timedelta(days=1),
+                                            index=index)
+            for _ in range(2)]
+        self.assertEqual([s["new"] for s in summaries], [1, 1])
+        self.assertIs(summaries[0]["changes"][proposal.pk]["proposal"],
+                      summaries[1]["changes"][proposal.pk]["proposal"])
+
+        # Without a start date, every matching proposal is new:
+        summary = changes.summarize_query_updates(
+            {"address": "1 Cherry Street"})
+        self.assertEqual(summary["new"], 1)
+
+
 @tag("inbound", "mail")
 class TestInboundParser(TestCase):
     def test_key(self):